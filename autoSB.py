@@ -20,24 +20,36 @@ from datetime import datetime
 import time
 import io
 import re
-
-__all__ = ['splitall', 'splitall2', 'remove_files', 'trunc', 'replace_in_file',
-           'get_title_from_data', 'get_root_flexibly', 'add_element_to_xml', 'fix_attrdomv_error',
+import fnmatch
+import hashlib
+import sqlite3
+from collections.abc import MutableMapping
+import copy
+import threading
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from find_replace import overlaps, process_pool
+
+__all__ = ['splitall', 'splitall2', 'ReleaseManifest', 'remove_files', 'trunc', 'replace_in_file',
+           'get_title_from_data', 'get_root_flexibly', 'XmlDocCache', 'add_element_to_xml', 'fix_attrdomv_error',
            'remove_xml_element', 'replace_element_in_xml', 'map_newvals2xml',
-           'find_and_replace_text', 'find_and_replace_from_dict',
-           'update_xml_tagtext', 'flip_dict', 'update_xml', 'update_all_xmls', 'json_from_xml',
-           'get_fields_from_xml', 'log_in', 'log_in2', 'flexibly_get_item',
-           'get_DOI_from_item', 'fix_falsefolder', 'rename_dirs_from_xmls', 'setup_subparents', 'inherit_SBfields', 'find_or_create_child',
-           'upsert_metadata', 'replace_files_by_ext', 'upload_files', 'upload_files_matching_xml',
-           'upload_shp', 'find_browse_in_json', 'update_browse', 'update_all_browse_graphics', 'upload_all_updated_xmls', 'get_parent_bounds', 'get_idlist_bottomup',
+           'find_and_replace_text', 'find_and_replace_in_text', 'xml_content_hash', 'write_xml', 'find_and_replace_from_dict',
+           'update_xml_tagtext', 'flip_dict', 'update_xml', 'process_pool', 'update_all_xmls', 'json_from_xml',
+           'get_fields_from_xml', 'ItemCache', 'CachedSbSession', 'RunReport', 'InstrumentedSbSession', 'log_in', 'log_in2', 'flexibly_get_item',
+           'get_DOI_from_item', 'fix_falsefolder', 'rename_dirs_from_xmls', 'setup_subparents', 'inherit_SBfields', 'ChildIndex', 'poll_until', 'wait_for_children', 'find_or_create_child',
+           'upsert_metadata', 'replace_files_by_ext', 'FileManifest', 'StateStore', 'file_md5', 'list_upload_files', 'list_item_files', 'sync_files',
+           'upload_files', 'upload_datapage', 'upload_all_datapages', 'upload_files_matching_xml',
+           'upload_shp', 'find_browse_in_json', 'update_browse', 'update_all_browse_graphics', 'upload_all_updated_xmls', 'get_item_bbox', 'get_bounds_from_xml', 'get_xml_extents', 'union_bbox', 'get_parent_bounds', 'get_idlist_bottomup',
            'set_parent_extent', 'find_browse_file', 'upload_all_previewImages2', 'upload_all_previewImages', 'shp_to_new_child',
            'update_datapage', #'update_subpages_from_landing',
-           'get_pageid_from_xmlpath',
+           'get_pageid_from_xmlpath', 'PageIndex',
            'update_pages_from_XML_and_landing', 'remove_all_files',
            'update_existing_fields',
            'delete_all_children', 'remove_all_child_pages',
            'check_fields', 'check_fields2', 'check_fields3', 'check_fields2_topdown',
-           'landing_page_from_parentdir', 'inherit_topdown',
+           'landing_page_from_parentdir', 'TreeSnapshot', 'inherit_topdown',
            'apply_topdown', 'apply_bottomup', 'restore_original_xmls']
 
 
@@ -73,11 +85,132 @@ def splitall2(path):
             path = parts[0]
     return(allparts2)
 
-def remove_files(parentdir, pattern='**/*.xml_orig'):
+class ReleaseManifest(object):
+    # Inventory of the data release directory tree, made with a single walk using os.scandir.
+    # For each directory, records the size and modified time of each file and the names of subdirectories,
+    # so that each phase can list XMLs, data files, and browse images without walking the tree again.
+    # Hidden files and directories (e.g. .assistants) are skipped, as they are by glob.
+    # Keep it current with rename_dir(), refresh(), and touch() when the tree is changed.
+    browse_exts = ('.png', '.jpg', '.jpeg', '.gif')
+
+    def __init__(self, parentdir):
+        self.parentdir = os.path.normpath(parentdir)
+        self.dirs = {}
+        self.refresh(self.parentdir)
+
+    def _scan(self, top):
+        # Walk the directory tree from top, recording files and subdirectories
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            files = {}
+            subdirs = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime)
+            except OSError as e:
+                print("Could not list directory {}: {}".format(dirpath, e))
+            self.dirs[dirpath] = {'files': files, 'subdirs': sorted(subdirs)}
+
+    def _subtree(self, dirpath):
+        # List dirpath and all directories below it, parents before children, in sorted order
+        dirlist = []
+        stack = [os.path.normpath(dirpath)]
+        while stack:
+            d = stack.pop()
+            if not d in self.dirs:
+                continue
+            dirlist.append(d)
+            stack.extend(reversed([os.path.join(d, sd) for sd in self.dirs[d]['subdirs']]))
+        return(dirlist)
+
+    def refresh(self, dirpath=None):
+        # Rescan a directory and everything below it
+        dirpath = os.path.normpath(dirpath or self.parentdir)
+        for d in self._subtree(dirpath):
+            self.dirs.pop(d, None)
+        self._scan(dirpath)
+        return(self)
+
+    def rename_dir(self, olddir, newdir):
+        # Re-key a renamed directory and everything below it without rescanning
+        olddir, newdir = os.path.normpath(olddir), os.path.normpath(newdir)
+        for d in self._subtree(olddir):
+            self.dirs[newdir + d[len(olddir):]] = self.dirs.pop(d)
+        parent = self.dirs.get(os.path.dirname(olddir))
+        if parent:
+            parent['subdirs'] = sorted([sd for sd in parent['subdirs'] if sd != os.path.basename(olddir)] + [os.path.basename(newdir)])
+
+    def touch(self, fpath):
+        # Update the record for a single file that was created, modified, or removed
+        dirpath, fname = os.path.split(os.path.normpath(fpath))
+        if not dirpath in self.dirs:
+            return
+        if os.path.isfile(fpath):
+            st = os.stat(fpath)
+            self.dirs[dirpath]['files'][fname] = (st.st_size, st.st_mtime)
+        else:
+            self.dirs[dirpath]['files'].pop(fname, None)
+
+    def files(self, pattern='*', dirpath=None, recursive=True):
+        # List paths of files whose names match the glob-style pattern
+        dirlist = self._subtree(dirpath or self.parentdir) if recursive else [os.path.normpath(dirpath or self.parentdir)]
+        flist = []
+        for d in dirlist:
+            for fname in sorted(self.dirs.get(d, {'files': {}})['files']):
+                if fnmatch.fnmatch(fname, pattern):
+                    flist.append(os.path.join(d, fname))
+        return(flist)
+
+    def xmls(self, dirpath=None, recursive=True):
+        return(self.files('*.xml', dirpath, recursive))
+
+    def xml_counts(self, dirpath=None):
+        # Count the XMLs in each directory's subtree (the directory and everything below it)
+        counts = {}
+        for d in reversed(self._subtree(dirpath or self.parentdir)):
+            counts[d] = len(fnmatch.filter(self.dirs[d]['files'], '*.xml'))
+            counts[d] += sum([counts.get(os.path.join(d, sd), 0) for sd in self.dirs[d]['subdirs']])
+        return(counts)
+
+    def subdirs(self, dirpath):
+        return([os.path.join(dirpath, sd) for sd in self.dirs.get(os.path.normpath(dirpath), {'subdirs': []})['subdirs']])
+
+    def browse_file(self, datadir, searchterm='*browse*'):
+        # Same search as find_browse_file(): first extension with a match wins
+        for ext in self.browse_exts:
+            imagelist = self.files(searchterm + ext, datadir, recursive=False)
+            if len(imagelist) > 0:
+                return(os.path.basename(imagelist[0]))
+        return
+
+    def size(self, fpath):
+        dirpath, fname = os.path.split(os.path.normpath(fpath))
+        return(self.dirs[dirpath]['files'][fname][0])
+
+    def mtime(self, fpath):
+        dirpath, fname = os.path.split(os.path.normpath(fpath))
+        return(self.dirs[dirpath]['files'][fname][1])
+
+def remove_files(parentdir, pattern='**/*.xml_orig', release=None):
     # Recursively remove files matching pattern
-    xmllist = glob.glob(os.path.join(parentdir, pattern), recursive=True)
+    # If a ReleaseManifest is given for a recursive pattern, files are listed from it instead of walking the tree.
+    if release is not None and pattern.startswith('**/'):
+        xmllist = release.files(pattern[3:], parentdir)
+    else:
+        xmllist = glob.glob(os.path.join(parentdir, pattern), recursive=True)
     for xml_file in xmllist:
         os.remove(xml_file)
+        if release is not None:
+            release.touch(xml_file)
     return(parentdir)
 
 ###################################################
@@ -101,10 +234,10 @@ def replace_in_file(fname, fstr, rstr, fill='xxx'):
         f.write(s)
     return(fname)
 
-def get_title_from_data(xml_file, metadata_root=False):
+def get_title_from_data(xml_file, metadata_root=False, docs=None):
     try:
         if not metadata_root:
-            tree = etree.parse(xml_file) # parse metadata using etree
+            tree = docs.get(xml_file) if docs is not None else etree.parse(xml_file) # parse metadata using etree
             metadata_root=tree.getroot()
         title = metadata_root.findall('./idinfo/citation/citeinfo/title')[0].text # Get title of child from XML
         return title
@@ -112,9 +245,10 @@ def get_title_from_data(xml_file, metadata_root=False):
         print("Exception while trying to parse XML file ({}): {}".format(xml_file, e), file=sys.stderr)
         return False
 
-def get_root_flexibly(in_metadata):
+def get_root_flexibly(in_metadata, docs=None):
     # Whether in_metadata is a filename or an element, get metadata_root
     # in_metadata accepts either xml file or root element of parsed metadata.
+    # If an XmlDocCache is given, the parsed tree is taken from it.
     if type(in_metadata) is etree._Element:
         metadata_root = in_metadata
         tree = False
@@ -122,7 +256,7 @@ def get_root_flexibly(in_metadata):
     elif type(in_metadata) is str:
         xml_file = in_metadata
         try:
-            tree = etree.parse(xml_file) # parse metadata using etree
+            tree = docs.get(xml_file) if docs is not None else etree.parse(xml_file) # parse metadata using etree
         except etree.XMLSyntaxError as e:
             print("XML Syntax Error while trying to parse XML file: {}".format(e))
             return False
@@ -134,6 +268,112 @@ def get_root_flexibly(in_metadata):
         print("{} is not an accepted variable type for 'in_metadata'".format(in_metadata))
     return(metadata_root, tree, xml_file)
 
+class XmlDocCache(object):
+    # LRU store of parsed metadata XML documents shared by the XML helpers, keyed by path.
+    # A document is parsed again only if the file's modified time or size has changed on disk since it was parsed.
+    # Helpers that modify a document mark it dirty instead of writing it; flush() writes each
+    # dirty document once, with any text find-and-replace queued for it, unless its content
+    # is unchanged apart from the metadata date.
+    # At most maxsize documents are kept; a dirty document is written when it is dropped.
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.docs = OrderedDict() # path: [(mtime, size), tree]
+        self.dirty = set()
+        self.find_replace = {} # path: {find_value: replace_value}
+        self.parsed = 0
+        self.written = 0
+        self.unchanged = 0
+        self.evicted = 0
+        self._lock = threading.RLock()
+
+    def _stamp(self, path):
+        # Modified time and size of the file, to tell whether it changed since it was parsed
+        st = os.stat(path)
+        return((st.st_mtime, st.st_size))
+
+    def get(self, xml_file):
+        # Return the parsed tree for xml_file, parsing it only if it is new or changed on disk.
+        # Raises the same exceptions as etree.parse.
+        path = os.path.abspath(xml_file)
+        with self._lock:
+            doc = self.docs.get(path)
+            if doc:
+                self.docs.move_to_end(path)
+            if doc and path in self.find_replace:
+                # Text replacements are queued for the document: apply them before it is edited again
+                text = find_and_replace_in_text(etree.tostring(doc[1]).decode('utf-8'), self.find_replace.pop(path))
+                doc[1] = etree.fromstring(text.encode('utf-8')).getroottree()
+                return(doc[1])
+            if doc and (path in self.dirty or doc[0] == self._stamp(path)):
+                return(doc[1])
+            tree = etree.parse(xml_file)
+            self.parsed += 1
+            self.docs[path] = [self._stamp(path), tree]
+            self.docs.move_to_end(path)
+            self._evict()
+            return(tree)
+
+    def _evict(self):
+        # Drop the least recently used documents beyond maxsize, writing any that are dirty
+        while len(self.docs) > self.maxsize:
+            path = next(iter(self.docs))
+            if path in self.dirty:
+                self.flush(path)
+            self.docs.pop(path, None)
+            self.evicted += 1
+
+    def mark_dirty(self, xml_file, find_replace=None):
+        # Record that the document was modified, with optional text replacements to make when it is written
+        path = os.path.abspath(xml_file)
+        with self._lock:
+            self.dirty.add(path)
+            if find_replace:
+                self.find_replace[path] = find_replace
+
+    def flush(self, xml_file=None):
+        # Write the dirty document for xml_file, or all dirty documents. Returns the list of files written.
+        with self._lock:
+            paths = [os.path.abspath(xml_file)] if xml_file else sorted(self.dirty)
+            written = []
+            for path in paths:
+                if not path in self.dirty:
+                    continue
+                doc = self.docs[path]
+                find_dict = self.find_replace.pop(path, None)
+                self.dirty.discard(path)
+                if write_xml(doc[1], path, find_dict, skip_unchanged=True) is None:
+                    self.unchanged += 1
+                    del self.docs[path] # read the file as it is on disk next time
+                    continue
+                if find_dict:
+                    del self.docs[path] # the replacements were made to the text, not the tree
+                else:
+                    doc[0] = self._stamp(path)
+                self.written += 1
+                written.append(path)
+            return(written)
+
+    def discard(self, xml_file):
+        # Drop the document and any unsaved changes to it
+        path = os.path.abspath(xml_file)
+        with self._lock:
+            self.docs.pop(path, None)
+            self.dirty.discard(path)
+            self.find_replace.pop(path, None)
+
+    def rename_dir(self, olddir, newdir):
+        # Re-key the documents in a renamed directory
+        olddir, newdir = os.path.abspath(olddir), os.path.abspath(newdir)
+        with self._lock:
+            for store in (self.docs, self.find_replace):
+                for path in [p for p in store if p.startswith(olddir + os.sep)]:
+                    store[newdir + path[len(olddir):]] = store.pop(path)
+            self.dirty = set([newdir + p[len(olddir):] if p.startswith(olddir + os.sep) else p for p in self.dirty])
+
+    def report(self):
+        return("XML documents: {} parsed, {} written, {} left unchanged, {} unsaved, {} dropped from the cache.".format(
+            self.parsed, self.written, self.unchanged, len(self.dirty), self.evicted))
+
 def add_element_to_xml(in_metadata, new_elem, containertag='./idinfo'):
     # Appends element 'new_elem' to 'containertag' in XML file. in_metadata accepts either xmlfile or root element of parsed metadata. new_elem accepts either lxml._Element or XML string
     # Whether in_metadata is a filename or an element, get metadata_root
@@ -284,6 +524,7 @@ def map_newvals2xml(new_values):
     accinstr = './distinfo/stdorder/digform/digtopt/onlinopt/accinstr'
     metadate = './metainfo/metd' # Metadata Date
     browsen = './idinfo/browse/browsen'
+    browset = './idinfo/browse/browset'
     # Initialize storage dictionary
     val2xml = {}
     # DOI values
@@ -312,6 +553,10 @@ def map_newvals2xml(new_values):
         if 'browse_file' in new_values.keys():
             browse_link = '{}/?name={}'.format(directdownload_link, new_values['browse_file'])
             val2xml[browse_link] = {browsen:0}
+            # Browse type from the file extension, as update_browse sets it, so the XML doesn't change again after the upload
+            browse_type = os.path.splitext(new_values['browse_file'])[1][1:].upper()
+            if browse_type:
+                val2xml.setdefault(browse_type, {})[browset] = 0
     # Edition
     if 'edition' in new_values.keys():
         val2xml[new_values['edition']] = {edition:0}
@@ -331,14 +576,82 @@ def find_and_replace_text(fname, findstr='http:', replacestr='https:'):
     os.remove(fname+'.tmp')
     return fname
 
-def find_and_replace_from_dict(fname, find_dict):
+_find_replace_patterns = {}
+
+def _find_replace_pattern(find_dict):
+    # Compile the find values into one alternation if a single pass gives the same result as
+    # replacing each pair in turn: no find value can overlap another or the replacement value
+    # of an earlier pair, and no value is empty. Otherwise return None.
+    pairs = tuple(find_dict.items())
+    if not pairs in _find_replace_patterns:
+        if len(_find_replace_patterns) > 100:
+            _find_replace_patterns.clear()
+        pattern = re.compile('|'.join([re.escape(fstr) for fstr, rstr in pairs]))
+        for i, (fstr, rstr) in enumerate(pairs):
+            if not fstr or not rstr:
+                pattern = None
+            elif any([overlaps(fstr, f2) or overlaps(r2, fstr) for f2, r2 in pairs[:i]]):
+                pattern = None
+        _find_replace_patterns[pairs] = pattern
+    return(_find_replace_patterns[pairs])
+
+def find_and_replace_in_text(s, find_dict):
     # Takes dictionary of {find_value: replace_value}
-    ct = 0
-    with io.open(fname, 'r', encoding='utf-8') as f:
-        s = f.read()
+    # Replace all pairs in one pass over the text when that is equivalent to replacing them in turn.
+    if len(find_dict) > 1:
+        pattern = _find_replace_pattern(find_dict)
+        if pattern is not None:
+            return(pattern.sub(lambda m: find_dict[m.group(0)], s))
     # Iterate through find:replace pairs
     for fstr, rstr in find_dict.items():
         s = s.replace(fstr, rstr)
+    return(s)
+
+def xml_content_hash(in_xml, ignore=('./metainfo/metd',)):
+    # MD5 hash of the canonical (C14N) form of an XML file, tree, or element, with the text of the ignored elements
+    # removed, so that a file whose only change is the metadata date has the same hash.
+    if isinstance(in_xml, str):
+        in_xml = etree.parse(in_xml)
+    root = in_xml.getroot() if isinstance(in_xml, etree._ElementTree) else in_xml
+    saved = [(elem, elem.text) for path in ignore for elem in root.findall(path)]
+    try:
+        for elem, text in saved:
+            elem.text = None
+        canonical = etree.tostring(root, method='c14n')
+    finally:
+        for elem, text in saved:
+            elem.text = text
+    return(hashlib.md5(canonical).hexdigest())
+
+def write_xml(tree, xml_file, find_dict=None, skip_unchanged=False):
+    # Write the tree to xml_file, making the text replacements in find_dict on the serialized XML.
+    # Gives the same file as tree.write() followed by find_and_replace_from_dict(), with one write.
+    # With skip_unchanged, the file is left as it is if only volatile elements (the metadata date) would change;
+    # returns None in that case, so that its modified time doesn't trigger another upload.
+    s = None
+    if find_dict:
+        s = etree.tostring(tree).decode('utf-8')
+        s = s.replace('\r\n', '\n').replace('\r', '\n') # as when the file is read in text mode
+        s = find_and_replace_in_text(s, find_dict)
+    if skip_unchanged and os.path.isfile(xml_file):
+        try:
+            new_hash = xml_content_hash(etree.fromstring(s.encode('utf-8')) if s is not None else tree)
+            if new_hash == xml_content_hash(xml_file):
+                return(None)
+        except etree.XMLSyntaxError:
+            pass # write the file and let the usual checks catch the problem
+    if s is None:
+        tree.write(xml_file)
+        return(xml_file)
+    with io.open(xml_file, 'w', encoding='utf-8') as f:
+        f.write(s)
+    return(xml_file)
+
+def find_and_replace_from_dict(fname, find_dict):
+    # Takes dictionary of {find_value: replace_value}
+    with io.open(fname, 'r', encoding='utf-8') as f:
+        s = f.read()
+    s = find_and_replace_in_text(s, find_dict)
     with io.open(fname, 'w', encoding='utf-8') as f:
         f.write(s)
     return(fname)
@@ -376,8 +689,9 @@ def flip_dict(in_dict, verbose=False):
                 out_dict[fstr][idx] = newval
     return(out_dict)
 
-def update_xml(xml_file, new_values, verbose=False):
+def update_xml(xml_file, new_values, verbose=False, docs=None):
     # update XML file to include new child ID and DOI
+    # If an XmlDocCache is given, the changes are made to its copy of the document and written when it is flushed.
     #%% Map new values to their appropriate metadata elements
     e2nv = map_newvals2xml(new_values)
     e2nv_flipped = flip_dict(e2nv, verbose=False)
@@ -386,7 +700,7 @@ def update_xml(xml_file, new_values, verbose=False):
     if not os.path.exists(xml_file+'_orig'):
         shutil.copy(xml_file, xml_file+'_orig')
     # Parse metadata
-    metadata_root, tree, xml_file = get_root_flexibly(xml_file)
+    metadata_root, tree, xml_file = get_root_flexibly(xml_file, docs)
     # Update elements with new text values
     for fstr, idx_val in e2nv_flipped.items():
         for idx in sorted(idx_val):
@@ -403,33 +717,95 @@ def update_xml(xml_file, new_values, verbose=False):
     #%% Fix common error in which attrdomv has multiple subelements
     metadata_root = fix_attrdomv_error(metadata_root)
     #%% Save changes - overwrite XML file with new XML
-    tree.write(xml_file)
-    #%% Perform find and replace the text in the file
-    if "find_and_replace" in new_values:
-        find_and_replace_from_dict(xml_file, new_values['find_and_replace'])
+    # Perform find and replace on the text of the file as it is written
+    if docs is not None:
+        docs.mark_dirty(xml_file, new_values.get('find_and_replace'))
+        return(xml_file)
+    write_xml(tree, xml_file, new_values.get('find_and_replace'), skip_unchanged=True)
     return(xml_file)
 
-def update_all_xmls(parentdir, new_values, sb=None, dict_DIRtoID=None, verbose=True):
-    # Update every XML in the directory tree with new values (from config file and SB)
+def _update_xml_job(job):
+    # Run update_xml in a worker process. Returns what it printed and any error instead of raising.
+    xml_file, new_values, verbose = job
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            update_xml(xml_file, new_values, verbose=verbose)
+        return(xml_file, log.getvalue(), None)
+    except Exception as e:
+        return(xml_file, log.getvalue(), "{}: {}".format(type(e).__name__, e))
+
+def update_all_xmls(parentdir, new_values, sb=None, dict_DIRtoID=None, verbose=True, release=None, docs=None, workers=1, pages=None,
+                    xmllist=None):
+    # Update every XML in the directory tree (or only those in xmllist) with new values (from config file and SB)
     # Does not upload resulting XML to SB.
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    # If a ReleaseManifest is given, XMLs and browse files are listed from it and it is updated with the changed files.
+    # If an XmlDocCache is given, documents are taken from it and all changes are written at the end.
+    # With workers > 1, page IDs and browse files are found first, then the XMLs are updated in a process pool.
+    # The output of each file is printed in order. In either case a failed file does not stop the others.
+    # Returns the list of (xml_file, error) failures.
+    if xmllist is None:
+        xmllist = release.xmls(parentdir) if release is not None else glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    pool = process_pool(workers)
+    if pool is not None and docs is not None:
+        docs.flush() # workers read the files from disk
+    jobs = []
+    failures = []
     for xml_file in xmllist:
         # Update XML
         # Get SB values
-        datapageid = get_pageid_from_xmlpath(xml_file, sb, dict_DIRtoID, parentdir=parentdir, verbose=False)
+        try:
+            datapageid = get_pageid_from_xmlpath(xml_file, sb, dict_DIRtoID, parentdir=parentdir, verbose=False, docs=docs, pages=pages)
+        except Exception as e:
+            print("FAILED to find page ID for XML {}: {}".format(xml_file, e))
+            failures.append((xml_file, "{}: {}".format(type(e).__name__, e)))
+            continue
         # add SB UID to be updated in XML
         new_values['child_id'] = datapageid
         # Look for browse graphic in directory with XML
         datadir = os.path.dirname(xml_file)
-        browse_file = find_browse_file(datadir)
+        browse_file = find_browse_file(datadir, release=release)
         new_values.pop('browse_file', None) # remove value from past iteration
         if browse_file:
             new_values['browse_file'] = browse_file
+        if pool is not None:
+            jobs.append((xml_file, dict(new_values), verbose))
+            continue
         # Make the changes to the XML based on the new_values dictionary
-        update_xml(xml_file, new_values, verbose=verbose) # new_values['pubdate']
+        try:
+            update_xml(xml_file, new_values, verbose=verbose, docs=docs) # new_values['pubdate']
+        except Exception as e:
+            print("FAILED to update XML {}: {}".format(xml_file, e))
+            failures.append((xml_file, "{}: {}".format(type(e).__name__, e)))
+            if docs is not None:
+                docs.discard(xml_file) # don't write a partly updated document
+            continue
+        if release is not None:
+            release.touch(xml_file+'_orig')
+            if docs is None:
+                release.touch(xml_file)
         if verbose:
             print("UPDATED XML: {}".format(xml_file))
-    return
+    if pool is not None:
+        with pool:
+            for xml_file, log, error in pool.map(_update_xml_job, jobs, chunksize=max(1, len(jobs) // (workers*4))):
+                print(log, end='')
+                if error:
+                    print("FAILED to update XML {}: {}".format(xml_file, error))
+                    failures.append((xml_file, error))
+                    continue
+                if release is not None:
+                    release.touch(xml_file+'_orig')
+                    release.touch(xml_file)
+                if verbose:
+                    print("UPDATED XML: {}".format(xml_file))
+    if failures:
+        print("{} of {} XMLs could not be updated.".format(len(failures), len(xmllist)))
+    if docs is not None:
+        for xml_file in docs.flush():
+            if release is not None:
+                release.touch(xml_file)
+    return(failures)
 
 def json_from_xml():
     #FIXME: Currently hard-wired; will need to adapted to match metadata scheme.
@@ -440,10 +816,10 @@ def json_from_xml():
     dict_xml2sb['body'] = {'./idinfo/descript/abstract':0}
     return dict_xml2sb
 
-def get_fields_from_xml(sb, item, xml_file, sbfields, metadata_root=False):
+def get_fields_from_xml(sb, item, xml_file, sbfields, metadata_root=False, docs=None):
     # Based on desired SB fields, get text values from XML
     if not metadata_root:
-        tree = etree.parse(xml_file) # parse metadata using etree
+        tree = docs.get(xml_file) if docs is not None else etree.parse(xml_file) # parse metadata using etree
         metadata_root=tree.getroot()
     dict_sb_from_xml = json_from_xml() # return dict for locating values in XML
     for field in sbfields:
@@ -461,8 +837,258 @@ def get_fields_from_xml(sb, item, xml_file, sbfields, metadata_root=False):
 # SB helper functions
 #
 ###################################################
-def log_in(username=None, password=None):
+class ItemCache(object):
+    # LRU store of SB JSON items keyed by item ID. Counts hits and misses.
+    # Items are copied in and out so that callers can modify what they get without changing the cache.
+    # Safe to share between upload threads.
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, item_id):
+        with self._lock:
+            if item_id in self._items:
+                self._items.move_to_end(item_id)
+                self.hits += 1
+                return(copy.deepcopy(self._items[item_id]))
+            self.misses += 1
+            return(None)
+
+    def put(self, item):
+        if not isinstance(item, dict) or not 'id' in item:
+            return
+        with self._lock:
+            self._items[item['id']] = copy.deepcopy(item)
+            self._items.move_to_end(item['id'])
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def peek(self, item_id):
+        # Return the cached item without copying or counting it as a hit
+        with self._lock:
+            return(self._items.get(item_id))
+
+    def invalidate(self, *item_ids):
+        with self._lock:
+            for item_id in item_ids:
+                self._items.pop(item_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0
+        return("Item cache: {} hits, {} misses ({:.0f}% hit rate), {} of max {} items held.".format(
+            self.hits, self.misses, rate, len(self._items), self.maxsize))
+
+def _item_id(id_or_json):
+    # Get item ID from either an ID string or an SB JSON item
+    if isinstance(id_or_json, dict):
+        return(id_or_json.get('id'))
+    return(id_or_json)
+
+class CachedSbSession(object):
+    # Wrap an SbSession so that get_item is served from an ItemCache.
+    # Methods that modify an item drop it (and its parent, whose hasChildren may change) from the cache.
+    # All other attributes are passed through to the wrapped session.
+    def __init__(self, sb, cache=None, maxsize=500):
+        if isinstance(sb, CachedSbSession):
+            sb = sb._sb
+        self._sb = sb
+        self.cache = cache if cache is not None else ItemCache(maxsize)
+
+    def __getattr__(self, name):
+        return(getattr(self._sb, name))
+
+    def get_item(self, itemid, params=None):
+        # Only full items are cached; requests for a subset of fields go straight to SB.
+        if params:
+            return(self._sb.get_item(itemid, params))
+        item = self.cache.get(itemid)
+        if item is None:
+            item = self._sb.get_item(itemid)
+            self.cache.put(item)
+        return(item)
+
+    def _invalidate_items(self, *items):
+        for item in items:
+            self.cache.invalidate(_item_id(item))
+            if isinstance(item, dict) and item.get('parentId'):
+                self.cache.invalidate(item['parentId'])
+
+    def create_item(self, item_json):
+        item = self._sb.create_item(item_json)
+        self._invalidate_items(item_json)
+        return(item)
+
+    def create_items(self, items_json):
+        items = self._sb.create_items(items_json)
+        self._invalidate_items(*items_json)
+        return(items)
+
+    def update_item(self, item_json):
+        self._invalidate_items(item_json)
+        return(self._sb.update_item(item_json))
+
+    def update_items(self, items_json):
+        self._invalidate_items(*items_json)
+        return(self._sb.update_items(items_json))
+
+    def upload_file_to_item(self, item, filename, *args, **kwargs):
+        self._invalidate_items(item)
+        return(self._sb.upload_file_to_item(item, filename, *args, **kwargs))
+
+    def upload_files_and_upsert_item(self, item, filenames, *args, **kwargs):
+        self._invalidate_items(item)
+        return(self._sb.upload_files_and_upsert_item(item, filenames, *args, **kwargs))
+
+    def upload_files_and_update_item(self, item, filenames, *args, **kwargs):
+        self._invalidate_items(item)
+        return(self._sb.upload_files_and_update_item(item, filenames, *args, **kwargs))
+
+    def replace_file(self, filename, item):
+        self._invalidate_items(item)
+        return(self._sb.replace_file(filename, item))
+
+    def delete_item(self, item_json):
+        self._invalidate_items(item_json)
+        return(self._sb.delete_item(item_json))
+
+    def delete_items(self, itemIds):
+        # Only IDs are given, so look up the parents among the cached items before dropping them.
+        self._invalidate_items(*[self.cache.peek(i) or i for i in itemIds])
+        return(self._sb.delete_items(itemIds))
+
+class RunReport(object):
+    # Wall time of each phase of a run and the SB calls made during it (counted by InstrumentedSbSession):
+    # calls, seconds, errors, and retries per method, and bytes uploaded.
+    # start_phase() ends the current phase, so phases can be marked in a script without indenting it.
+    def __init__(self):
+        self.started = datetime.now()
+        self.phases = OrderedDict() # name: {'seconds': float, 'calls': {method: {...}}, 'bytes_uploaded': int}
+        self.current = None
+        self._start = None
+        self._failed = set() # (method, item ID) of failed calls, to count retries
+        self._lock = threading.RLock()
+
+    def _phase(self, name):
+        return(self.phases.setdefault(name, {'seconds': 0.0, 'calls': {}, 'bytes_uploaded': 0}))
+
+    def start_phase(self, name):
+        with self._lock:
+            self.end_phase()
+            self.current = name
+            self._start = time.time()
+            self._phase(name)
+
+    def end_phase(self):
+        with self._lock:
+            if self.current is not None:
+                self._phase(self.current)['seconds'] += time.time() - self._start
+            self.current = None
+
+    def record_call(self, method, seconds, key=None, nbytes=0, error=False):
+        # Add one SB call to the current phase ('other' outside of phases)
+        with self._lock:
+            phase = self._phase(self.current if self.current is not None else 'other')
+            stats = phase['calls'].setdefault(method, {'calls': 0, 'seconds': 0.0, 'errors': 0, 'retries': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            if (method, key) in self._failed:
+                stats['retries'] += 1
+                self._failed.discard((method, key))
+            if error:
+                stats['errors'] += 1
+                self._failed.add((method, key))
+            phase['bytes_uploaded'] += nbytes
+
+    def totals(self):
+        # Sum of the calls per method over all phases
+        out = {}
+        for phase in self.phases.values():
+            for method, stats in phase['calls'].items():
+                total = out.setdefault(method, {'calls': 0, 'seconds': 0.0, 'errors': 0, 'retries': 0})
+                for k in total:
+                    total[k] += stats[k]
+        return(out)
+
+    def summary(self):
+        # Table of time, SB calls, errors, retries, and MB uploaded per phase, followed by the calls per method
+        with self._lock:
+            self.end_phase()
+            lines = ["{:<28}{:>10}{:>9}{:>10}{:>8}{:>9}{:>11}".format('Phase', 'seconds', 'calls', 'SB secs', 'errors', 'retries', 'MB up')]
+            for name, phase in self.phases.items():
+                calls = phase['calls'].values()
+                lines.append("{:<28}{:>10.1f}{:>9}{:>10.1f}{:>8}{:>9}{:>11.1f}".format(trunc(name, 27), phase['seconds'],
+                             sum([c['calls'] for c in calls]), sum([c['seconds'] for c in calls]),
+                             sum([c['errors'] for c in calls]), sum([c['retries'] for c in calls]), phase['bytes_uploaded'] / 1e6))
+            lines.append("SB calls by method:")
+            for method, stats in sorted(self.totals().items(), key=lambda x: -x[1]['calls']):
+                lines.append("  {:<36}{:>9} calls{:>10.1f} s{:>6} errors".format(method, stats['calls'], stats['seconds'], stats['errors']))
+            return('\n'.join(lines))
+
+    def save(self, fpath):
+        # Save the report as JSON, e.g. in stash_dir, to compare runs
+        with self._lock:
+            self.end_phase()
+            report = {'started': self.started.isoformat(), 'finished': datetime.now().isoformat(),
+                      'seconds': sum([p['seconds'] for p in self.phases.values()]),
+                      'phases': self.phases, 'totals': self.totals()}
+            os.makedirs(os.path.dirname(os.path.abspath(fpath)), exist_ok=True)
+            with open(fpath, 'w') as f:
+                json.dump(report, f, indent=2)
+        return(fpath)
+
+class InstrumentedSbSession(object):
+    # Wrap an SbSession so that each call is timed and counted in a RunReport, with the size of any uploaded files.
+    # Place it inside CachedSbSession so that only calls that reach SB are counted.
+    # All other attributes are passed through to the wrapped session.
+    uncounted = ('is_logged_in', 'login', 'loginc', 'logout')
+
+    def __init__(self, sb, report):
+        self._sb = sb
+        self.report = report
+
+    def __getattr__(self, name):
+        attr = getattr(self._sb, name)
+        if name.startswith('_') or name in self.uncounted or not callable(attr):
+            return(attr)
+        def instrumented(*args, **kwargs):
+            nbytes = 0
+            if 'upload' in name or name == 'replace_file':
+                for arg in args:
+                    for fn in (arg if isinstance(arg, (list, tuple)) else [arg]):
+                        if isinstance(fn, str) and os.path.isfile(fn):
+                            nbytes += os.path.getsize(fn)
+            key = _item_id(args[0]) if args and isinstance(args[0], (str, dict)) else None
+            start = time.time()
+            try:
+                out = attr(*args, **kwargs)
+            except Exception:
+                self.report.record_call(name, time.time() - start, key, error=True)
+                raise
+            self.report.record_call(name, time.time() - start, key, nbytes)
+            return(out)
+        return(instrumented)
+
+def log_in(username=None, password=None, cache=None, session=None):
+    # If an ItemCache is given, the session is wrapped so that it shares that cache with earlier sessions.
+    # If a session is given, it is used instead of a new session (logging it back in if needed), so that
+    # any wrappers around it (e.g. InstrumentedSbSession) are kept.
     print('Logging in if necessary...')
+    if session is not None:
+        if not session.is_logged_in():
+            print('Logging back in...')
+            if password:
+                session.login(username, password)
+            else:
+                session.loginc(username)
+        return CachedSbSession(session, cache) if cache is not None else session
     if 'sb' in globals():
         if not sb.is_logged_in():
             print('Logging back in...')
@@ -481,6 +1107,8 @@ def log_in(username=None, password=None):
         except NameError as e:
             print('{}. Try reentering...'.format(e))
             sb = pysb.SbSession(env=None).loginc(username)
+    if cache is not None:
+        sb = CachedSbSession(sb, cache)
     return sb
 
 def log_in2(username=False, password=False, sb=[]):
@@ -538,33 +1166,39 @@ def fix_falsefolder(sb, falsefolder_id, useremail, password):
         print("Still recognized as a folder... :(")
     return
 
-def rename_dirs_from_xmls(parentdir, rename_intermediates=True):
+def rename_dirs_from_xmls(parentdir, rename_intermediates=True, release=None, docs=None):
     """
     Rename directories that contain a single XML. Rename the directory to the title in the XML file.
     Notes:
     - I have run this on OSX with colons in the titles without issue. The renamed directories have backslash instead of colon, but the ScienceBase page titles have colons even though they are copied from the directory names.
     - Use rename_intermediates to specify whether directory must not contain sub-directories.
     - Although colons don't seem to be a problem on Mac, parentheses might be. Don't include parentheses in titles.
+    - The directory tree is scanned once (or taken from the ReleaseManifest, if given) and renamed directories are updated in the manifest.
+    - Directories are renamed deepest first, so that the paths of directories not yet renamed stay valid.
     """
     # List characters that are invalid pathnames in OSX (:) or Windows (the rest).
     invalid_chars = r'< > : " / \ | ? *'.split(' ')
     # Initialize
     ct = 0
     invalid_titles = []
-    # For all XML files...
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    if release is None:
+        release = ReleaseManifest(parentdir)
+    # Count XMLs in each directory subtree
+    xml_counts = release.xml_counts(parentdir)
+    # For all XML files, deepest directories first...
+    xmllist = sorted(release.xmls(parentdir), key=lambda fp: -fp.count(os.sep))
     for xml_file in xmllist:
         datadir = os.path.dirname(xml_file)
         # Check whether directory meets conditions: contains only one XML and (optionally) does not contain subdirectories.
         go = False
-        if [len(glob.glob(os.path.join(datadir, '**/*.xml'), recursive=True)) == 1]:
+        if xml_counts.get(datadir) == 1:
             go = True
             # and doesn't contain sub-directories...
-            if rename_intermediates and any([os.path.isdir(os.path.join(datadir,fn)) for fn in os.listdir(datadir)]):
+            if rename_intermediates and len(release.subdirs(datadir)):
                 go = False
         # If directory meets the conditions, rename it.
         if go:
-            data_title = get_title_from_data(xml_file)
+            data_title = get_title_from_data(xml_file, docs=docs)
             data_title = data_title.strip('\n')
             # Rename if the values don't already match
             basedir = os.path.dirname(datadir)
@@ -573,72 +1207,203 @@ def rename_dirs_from_xmls(parentdir, rename_intermediates=True):
                 if any(x in data_title for x in invalid_chars):
                     invalid_titles += [data_title]
                 os.rename(datadir, os.path.join(basedir, data_title))
+                release.rename_dir(datadir, os.path.join(basedir, data_title))
+                if docs is not None:
+                    docs.rename_dir(datadir, os.path.join(basedir, data_title))
                 ct+=1
     if len(invalid_titles):
         print('WARNING: The following titles include invalid characters. Consider changing:\n{}'.format('\n'.join(invalid_titles)))
     print("Renamed {} directories.".format(ct))
     return
 
-def setup_subparents(sb, parentdir, landing_id, imagefile, verbose=True):
+def setup_subparents(sb, parentdir, landing_id, imagefile, verbose=True, dict_DIRtoID=None, release=None, batch_size=100):
+    # Pass a StateStore as dict_DIRtoID to record each page ID as soon as the page is found or created.
+    # Pages are set up one directory level at a time: existing pages are found in a ChildIndex and all of
+    # the missing pages at a level are created together with create_items.
     landing_item = sb.get_item(landing_id)
     # Initialize dictionaries
-    dict_DIRtoID = {os.path.basename(parentdir): landing_id} # Initialize [top dir/file: ID] entry to dict
+    if dict_DIRtoID is None:
+        dict_DIRtoID = {}
+    dict_DIRtoID[os.path.basename(parentdir)] = landing_id # Initialize [top dir/file: ID] entry to dict
     # List XML files
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    xmllist = release.xmls(parentdir) if release is not None else glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    # List the directories that need a page, by depth
+    levels = []
+    listed = set()
     for xml_file in xmllist:
         # get relative path from parentdir to XML, including parentdir
         relpath = os.path.relpath(xml_file, os.path.dirname(parentdir))
-        # Find or create the SB page for each directory
         dirchain = splitall2(os.path.dirname(relpath))
-        for dirpath in dirchain[1:]:
-            parent_id = dict_DIRtoID[os.path.dirname(dirpath)] # get ID for parent
+        for depth, dirpath in enumerate(dirchain[1:]):
+            if len(levels) <= depth:
+                levels.append([])
+            if not dirpath in listed:
+                listed.add(dirpath)
+                levels[depth].append(dirpath)
+    index = ChildIndex()
+    for dirlist in levels:
+        # Find the SB page for each directory
+        subpages = []
+        new_dirs = []
+        for dirpath in dirlist:
             if dirpath in dict_DIRtoID:
                 continue
-            subpage = find_or_create_child(sb, parent_id, os.path.basename(dirpath), verbose=verbose) # get JSON for subpage based on parent ID and dirpath
-            if not imagefile == False:
-                subpage = sb.upload_file_to_item(subpage, imagefile)
-            # store values in dictionaries
-            dict_DIRtoID[dirpath] = subpage['id']
+            parent_id = dict_DIRtoID[os.path.dirname(dirpath)] # get ID for parent
+            child_id = index.lookup(sb, parent_id, os.path.basename(dirpath))
+            if child_id:
+                if verbose:
+                    print("FOUND: page '{}'.".format(trunc(os.path.basename(dirpath))))
+                dict_DIRtoID[dirpath] = child_id
+                subpages.append(child_id)
+            else:
+                new_dirs.append(dirpath)
+        # Create the missing pages at this level
+        for i in range(0, len(new_dirs), batch_size):
+            batch = new_dirs[i:i+batch_size]
+            new_items = [{'parentId': dict_DIRtoID[os.path.dirname(d)], 'title': os.path.basename(d)} for d in batch]
+            # create_items returns the new items in the order they were sent
+            created = sb.create_items(new_items)
+            if len(created) != len(batch):
+                raise Exception("create_items returned {} pages for {} directories.".format(len(created), len(batch)))
+            for dirpath, subpage in zip(batch, created):
+                index.update(subpage)
+                index.titles[subpage['id']] = {} # a new page has no children yet, so don't list them from SB
+                # store values in dictionaries
+                dict_DIRtoID[dirpath] = subpage['id']
+                subpages.append(subpage)
+                if verbose:
+                    print("CREATED PAGE: '{}' in '{}.'".format(trunc(subpage['title'], 40), os.path.basename(os.path.dirname(dirpath))))
+            # Make sure the new pages are registered before creating their children
+            parents = {}
+            for item in created:
+                parents.setdefault(item['parentId'], []).append(item['id'])
+            for parent_id, child_ids in parents.items():
+                wait_for_children(sb, parent_id, child_ids)
+        if not imagefile == False:
+            for subpage in subpages:
+                sb.upload_file_to_item(flexibly_get_item(sb, subpage), imagefile)
     return(dict_DIRtoID)
 
-def inherit_SBfields(sb, child_item, inheritedfields=['citation'], verbose=False, inherit_void=True):
+def inherit_SBfields(sb, child_item, inheritedfields=['citation'], verbose=False, inherit_void=True, parent_item=None):
     # Upsert inheritedfield from parent to child by retrieving parent_item based on child
     # Modified 3/8/17: if field does not exist in parent, remove in child
     # If field is entered incorrecly, no errors will be thrown, but the page will not be updated.
-    parent_item = flexibly_get_item(sb, child_item['parentId'])
+    # parent_item can be passed in if it has already been retrieved.
+    # The child is only updated if an inherited field differs from the parent's; otherwise child_item itself is returned.
+    if parent_item is None:
+        parent_item = flexibly_get_item(sb, child_item['parentId'])
     if verbose:
         print("Inheriting fields from parent '{}'".format(trunc(parent_item['title'])))
+    changes = {}
     for field in inheritedfields:
         if not field in parent_item:
             if inherit_void:
-                child_item[field] = None
+                changes[field] = None
             else:
                 print("Field '{}' does not exist in parent and inherit_void is set to False so the current value will be preserved in child '{}'.".format(field, trunc(child_item['title'])))
         else:
-            try:
-                child_item[field] = parent_item[field]
-            except Exception as e:
-                print(e)
-                pass
+            changes[field] = parent_item[field]
+    # Compare the values structurally (nested dicts and lists) so that unchanged pages aren't written
+    changes = dict([(field, value) for field, value in changes.items() if child_item.get(field) != value])
+    if not changes:
+        return(child_item)
+    child_item.update(copy.deepcopy(changes))
     child_item = sb.update_item(child_item)
     return(child_item)
 
-def find_or_create_child(sb, parentid, child_title, verbose=False):
+class ChildIndex(object):
+    # Title to ID index of the children of each parent page. Each parent's children are listed with one paged
+    # find_items query that requests only titles, so finding a child by title doesn't need get_item for every child.
+    # Keep it current with update() when children are created or retitled.
+    def __init__(self, page_size=1000):
+        self.page_size = page_size
+        self.titles = {} # parentid: {title: id}
+        self.ids = {} # child id: (parentid, title)
+        self.queries = 0
+        self._lock = threading.RLock()
+
+    def children(self, sb, parentid):
+        # Return the {title: id} index for parentid, listing the children from SB the first time
+        with self._lock:
+            if not parentid in self.titles:
+                titles = {}
+                items = sb.find_items({'filter': 'parentIdExcludingLinks={}'.format(parentid),
+                                       'fields': 'title', 'max': self.page_size})
+                while items and 'items' in items:
+                    for item in items['items']:
+                        titles.setdefault(item['title'], item['id']) # the first match wins, as in find_or_create_child
+                        self.ids[item['id']] = (parentid, item['title'])
+                    items = sb.next(items)
+                self.titles[parentid] = titles
+                self.queries += 1
+            return(self.titles[parentid])
+
+    def lookup(self, sb, parentid, title):
+        return(self.children(sb, parentid).get(title))
+
+    def update(self, item):
+        # Record a new or retitled child from its JSON (only if its parent has already been listed)
+        with self._lock:
+            old = self.ids.pop(item['id'], None)
+            if old and self.titles.get(old[0], {}).get(old[1]) == item['id']:
+                del self.titles[old[0]][old[1]]
+            if item.get('parentId') in self.titles:
+                self.titles[item['parentId']].setdefault(item['title'], item['id'])
+                self.ids[item['id']] = (item['parentId'], item['title'])
+
+    def forget(self, parentid):
+        with self._lock:
+            self.titles.pop(parentid, None)
+
+def poll_until(check, timeout=10, delay=0.25, max_delay=2):
+    # Call check() until it returns True, waiting a growing delay between calls.
+    # Returns True, or False if check() is still False after timeout seconds.
+    start = time.time()
+    while True:
+        if check():
+            return(True)
+        if time.time() - start + delay > timeout:
+            return(False)
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def wait_for_children(sb, parentid, child_ids, timeout=10, delay=0.25):
+    # Wait until newly created pages are listed as children of parentid.
+    # Returns True once they are all listed or False after timeout seconds.
+    waiting = set(child_ids)
+    def listed():
+        waiting.difference_update(sb.get_child_ids(parentid))
+        return(not waiting)
+    if poll_until(listed, timeout, delay):
+        return(True)
+    print("WARNING: {} new page(s) not yet listed under {} after {} seconds.".format(len(waiting), parentid, timeout))
+    return(False)
+
+def find_or_create_child(sb, parentid, child_title, verbose=False, index=None):
     # Find or create new child page
-    for child_id in sb.get_child_ids(parentid): # Check if child page already exists
+    # If a ChildIndex is given, children are looked up by title in it; pass the same index to repeated calls to list each parent only once.
+    child_id = None
+    if index is not None:
+        child_id = index.lookup(sb, parentid, child_title) # Check if child page already exists
+    else:
+        for cid in sb.get_child_ids(parentid): # Check if child page already exists
+            if sb.get_item(cid)['title'] == child_title:
+                child_id = cid
+                break
+    if child_id:
         child_item = sb.get_item(child_id)
-        if child_item['title'] == child_title:
-            if verbose:
-                print("FOUND: page '{}'.".format(trunc(child_title)))
-            break
+        if verbose:
+            print("FOUND: page '{}'.".format(trunc(child_title)))
     else: # If child doesn't already exist, create
         child_item = {}
         child_item['parentId'] = parentid
         child_item['title'] = child_title
         child_item = sb.create_item(child_item)
+        if index is not None:
+            index.update(child_item)
         if verbose:
             print("CREATED PAGE: '{}' in '{}.'".format(trunc(child_title, 40), sb.get_item(parentid)['title']))
-        time.sleep(1) # wait 1 sec to ensure that page is registered
+        wait_for_children(sb, parentid, [child_item['id']]) # make sure that page is registered
     return child_item
 
 def get_file_upload_time(data_item, file_type='application/fgdc+xml'):
@@ -682,47 +1447,74 @@ def upsert_metadata(sb, id_or_item, xml_file):
     return(data_item)
 
 #%% Update SB preview image from the uploaded files.
-def update_all_browse_graphics(sb, parentdir, landing_id, valid_ids=None, verbose=False):
+def update_all_browse_graphics(sb, parentdir, landing_id, valid_ids=None, verbose=False, release=None, docs=None, pages=None, upload=True):
     # Update SB preview image from the uploaded files and update filename and type in XML.
+    # If an XmlDocCache is given, documents are taken from it and each changed XML is written once, before it is uploaded.
+    # With upload=False, changed XMLs are only written, to be uploaded once by upload_all_updated_xmls.
+    # Returns the number of XMLs that were changed.
     # For every XML in the parentdir (recursive)...
     print("Updating browse graphic information...")
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    xmllist = release.xmls(parentdir) if release is not None else glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    ct = 0
     for xml_file in xmllist:
         # Get SB page ID from the XML (needs to be up-to-date)
-        datapageid = get_pageid_from_xmlpath(xml_file, sb, valid_ids=valid_ids, parentdir=parentdir, verbose=verbose)
+        datapageid = get_pageid_from_xmlpath(xml_file, sb, valid_ids=valid_ids, parentdir=parentdir, verbose=verbose, docs=docs, pages=pages)
         # Run update_browse() to match the XML values with the image file on the SB page. Get browse caption from the XML. Get name of *browse* image file on SB and set as preview. Update the filename and type in the XML.
-        if update_browse(sb, xml_file, datapageid, verbose):
+        if update_browse(sb, xml_file, datapageid, verbose, docs=docs):
+            ct += 1
+            if docs is not None:
+                docs.flush(xml_file)
+            if release is not None:
+                release.touch(xml_file)
             # if the XML was updated, replace the XML on the page.
-            data_item = upsert_metadata(sb, datapageid, xml_file)
-    return
+            if upload:
+                data_item = upsert_metadata(sb, datapageid, xml_file)
+    return(ct)
 
-def upload_all_updated_xmls(sb, parentdir, valid_ids=None):
-    # Upload XMLs that have been updated since last upload to SB.
+def upload_all_updated_xmls(sb, parentdir, valid_ids=None, release=None, pages=None, manifest=None):
+    # Upload XMLs whose content differs from the XML on their SB page.
     # Iterates through local XMLs rather than starting on SB
+    # The MD5 of the local XML is compared with SB's checksum of the file with the same name. If SB doesn't report one,
+    # it is compared with the MD5 at its last upload in the manifest, or failing that, the modified time with the upload time.
+    # Returns the number of XMLs uploaded and the number that already matched SB.
     ct = 0
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
-    print("Searching {} XML files for changes since last upload...".format(len(xmllist)))
+    matched = 0
+    xmllist = release.xmls(parentdir) if release is not None else glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    print("Checking {} XML files against the XMLs on SB...".format(len(xmllist)))
     for xml_file in xmllist:
         # Get SB JSON item that corresponds to XML file (try matching folder name to SB or get second link in XML citeinfo) # Get page_id from the SB title or the SB citation in the XML file.
-        datapageid = get_pageid_from_xmlpath(xml_file, sb, valid_ids=valid_ids, parentdir=parentdir)
+        datapageid = get_pageid_from_xmlpath(xml_file, sb, valid_ids=valid_ids, parentdir=parentdir, pages=pages)
         data_item = flexibly_get_item(sb, datapageid, output='item')
-        # Get upload time of XML as UTC datetime object
-        xml_uploaded = get_file_upload_time(data_item, file_type='application/fgdc+xml')
-        xml_uploaded = datetime.strptime(xml_uploaded, '%Y-%m-%dT%H:%M:%SZ')
-        # Get modified time of local XML as UTC datetime
-        xml_modified = datetime.utcfromtimestamp(os.path.getmtime(xml_file))
-        # Replace the metadata file if the modified time is greater than the uploaded time
-        if xml_modified > xml_uploaded:
+        md5 = file_md5(xml_file, manifest)
+        sbfile = list_item_files(data_item).get(os.path.basename(xml_file))
+        if sbfile and sbfile['md5']:
+            changed = sbfile['md5'] != md5
+        elif manifest is not None and (manifest.get_file(xml_file) or {}).get('uploaded_md5'):
+            changed = manifest.get_file(xml_file)['uploaded_md5'] != md5
+        else:
+            # Get upload time of XML as UTC datetime object
+            xml_uploaded = get_file_upload_time(data_item, file_type='application/fgdc+xml')
+            # Get modified time of local XML as UTC datetime
+            xml_modified = datetime.utcfromtimestamp(release.mtime(xml_file) if release is not None else os.path.getmtime(xml_file))
+            changed = not xml_uploaded or xml_modified > datetime.strptime(xml_uploaded, '%Y-%m-%dT%H:%M:%SZ')
+        # Replace the metadata file if it has changed
+        if changed:
             data_item = upsert_metadata(sb, data_item, xml_file)
+            if manifest is not None:
+                manifest.set_file(xml_file, uploaded_md5=md5)
             # print('UPLOADED: {}'.format(os.path.basename(xml_file)))
             ct += 1
+        else:
+            matched += 1
     if ct > 0:
-        print("Found and uploaded {} XML files.\n".format(ct))
+        print("Found and uploaded {} XML files.".format(ct))
     else:
-        print("No XMLs have been updated since last upload.\n")
-    return
+        print("No XMLs have changed since last upload.")
+    print("Skipped {} XML files that match the XML on SB.\n".format(matched))
+    return(ct, matched)
 
 def replace_files_by_ext(sb, parentdir, dict_DIRtoID, match_str='*.xml', verbose=True):
+    index = ChildIndex()
     for root, dirs, files in os.walk(parentdir):
         for d in dirs:
             path = os.path.join(root, d)
@@ -731,28 +1523,282 @@ def replace_files_by_ext(sb, parentdir, dict_DIRtoID, match_str='*.xml', verbose
             for xml_file in xmllist:
                 parentid = dict_DIRtoID[reldirpath]
                 data_title = get_title_from_data(xml_file) # get title from XML
-                data_item = find_or_create_child(sb, parentid, data_title, verbose=verbose) # Create (or find) data page based on title
-                sb.replace_file(xml_file, data_item)
+                data_item = find_or_create_child(sb, parentid, data_title, verbose=verbose, index=index) # Create (or find) data page based on title
+                data_item = sb.replace_file(xml_file, data_item)
+                index.update(data_item) # SB may retitle the page from the new XML
                 print("REPLACED: {}".format(os.path.basename(xml_file)))
     return
 
-def upload_files(sb, item, xml_file, max_MBsize=2000, replace=True, verbose=False):
+class FileManifest(object):
+    # Local record of the size, modified time, and MD5 hash of each file, saved as JSON.
+    # Also records the hash of each file as of its last upload so that unchanged files can be skipped.
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._lock = threading.RLock()
+        self.files = {}
+        if os.path.isfile(fpath):
+            with open(fpath, 'r') as f:
+                self.files = json.load(f)
+
+    def get_file(self, path):
+        with self._lock:
+            return(self.files.get(os.path.abspath(path)))
+
+    def set_file(self, path, **values):
+        with self._lock:
+            self.files.setdefault(os.path.abspath(path), {}).update(values)
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.fpath)), exist_ok=True)
+            with open(self.fpath, 'w') as f:
+                json.dump(self.files, f)
+
+class StateStore(MutableMapping):
+    # SQLite record of the run state, saved in stash_dir:
+    # - page IDs for directories and XML files (used like the old dict_DIRtoID),
+    # - size, modified time, MD5 hash, and last upload of each file (same interface as FileManifest),
+    # - completed phases, and the paths that failed in a phase that didn't complete.
+    # Each write is committed immediately in its own transaction, so nothing is lost if the run stops.
+    # Page keys are paths relative to the directory above parentdir; absolute paths are converted.
+    def __init__(self, dbpath, parentdir):
+        self.dbpath = dbpath
+        self.parentdir = parentdir
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(os.path.abspath(dbpath)), exist_ok=True)
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self._lock, self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY, kind TEXT NOT NULL, page_id TEXT NOT NULL, updated TEXT)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS pages_page_id ON pages (page_id)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, md5 TEXT, uploaded_md5 TEXT, uploaded TEXT)""")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS phases (name TEXT PRIMARY KEY, completed TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS phase_failures (name TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (name, key))")
+        # Import the mappings from the JSON file used by earlier versions.
+        fname_dir2id = os.path.join(os.path.dirname(os.path.abspath(dbpath)), 'dir_to_id.json')
+        if not len(self) and os.path.isfile(fname_dir2id):
+            with open(fname_dir2id, 'r') as f:
+                self.update(json.load(f))
+            print("Imported {} page IDs from {}.".format(len(self), fname_dir2id))
+
+    def _key(self, key):
+        # Normalize key to the path relative to the directory above parentdir and get its kind ('xml' or 'dir')
+        if os.path.isabs(key):
+            key = os.path.relpath(key, os.path.dirname(self.parentdir))
+        key = os.path.normpath(key)
+        kind = 'xml' if key.lower().endswith('.xml') else 'dir'
+        return(key, kind)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return(self.conn.execute(sql, args).fetchall())
+
+    def _write(self, sql, args=()):
+        with self._lock, self.conn:
+            self.conn.execute(sql, args)
+
+    def __getitem__(self, key):
+        rows = self._query("SELECT page_id FROM pages WHERE key = ?", (self._key(key)[0],))
+        if not rows:
+            raise KeyError(key)
+        return(rows[0][0])
+
+    def __setitem__(self, key, page_id):
+        key, kind = self._key(key)
+        self._write("INSERT OR REPLACE INTO pages (key, kind, page_id, updated) VALUES (?, ?, ?, ?)",
+                    (key, kind, page_id, datetime.now().isoformat()))
+
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self._write("DELETE FROM pages WHERE key = ?", (self._key(key)[0],))
+
+    def __contains__(self, key):
+        return(bool(self._query("SELECT 1 FROM pages WHERE key = ?", (self._key(key)[0],))))
+
+    def __iter__(self):
+        return(iter([row[0] for row in self._query("SELECT key FROM pages ORDER BY rowid")]))
+
+    def __len__(self):
+        return(self._query("SELECT COUNT(*) FROM pages")[0][0])
+
+    def clear(self):
+        self._write("DELETE FROM pages")
+
+    def keys_for_page(self, page_id):
+        # List the directory and XML keys that map to page_id
+        return([row[0] for row in self._query("SELECT key FROM pages WHERE page_id = ?", (page_id,))])
+
+    # File records (same interface as FileManifest)
+    def get_file(self, path):
+        rows = self._query("SELECT size, mtime, md5, uploaded_md5, uploaded FROM files WHERE path = ?", (os.path.abspath(path),))
+        if not rows:
+            return(None)
+        return(dict(zip(('size', 'mtime', 'md5', 'uploaded_md5', 'uploaded'), rows[0])))
+
+    def set_file(self, path, **values):
+        if 'uploaded_md5' in values:
+            values.setdefault('uploaded', datetime.now().isoformat())
+        cols = [c for c in ('size', 'mtime', 'md5', 'uploaded_md5', 'uploaded') if c in values]
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (os.path.abspath(path),))
+            self.conn.execute("UPDATE files SET {} WHERE path = ?".format(', '.join('{} = ?'.format(c) for c in cols)),
+                              [values[c] for c in cols] + [os.path.abspath(path)])
+
+    def save(self):
+        # Writes are already committed.
+        return
+
+    # Phase completion
+    def mark_phase(self, name):
+        self._write("INSERT OR REPLACE INTO phases (name, completed) VALUES (?, ?)", (name, datetime.now().isoformat()))
+
+    def end_phase(self, name, failed=()):
+        # Mark the phase completed if no paths failed. Otherwise record the failed paths instead,
+        # so that a resumed run can retry only those (see phase_failures).
+        keys = sorted(set([self._key(fp)[0] for fp in failed]))
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM phase_failures WHERE name = ?", (name,))
+            if keys:
+                self.conn.executemany("INSERT INTO phase_failures (name, key) VALUES (?, ?)", [(name, key) for key in keys])
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO phases (name, completed) VALUES (?, ?)", (name, datetime.now().isoformat()))
+        if keys:
+            print("{} did not complete: {} paths failed and will be retried on the next run.".format(name, len(keys)))
+
+    def phase_failures(self, name):
+        # Full paths that failed the last time the phase ran; empty if it completed or hasn't run
+        rows = self._query("SELECT key FROM phase_failures WHERE name = ? ORDER BY key", (name,))
+        return([os.path.join(os.path.dirname(self.parentdir), row[0]) for row in rows])
+
+    def phase_completed(self, name):
+        rows = self._query("SELECT completed FROM phases WHERE name = ?", (name,))
+        return(rows[0][0] if rows else None)
+
+    def skip_phase(self, name):
+        # True (with a note) if the phase was completed by an earlier run that didn't finish, so it can be skipped.
+        completed = self.phase_completed(name)
+        if completed:
+            print("Skipping {}: completed by an earlier run at {}. Set reset_phases = True to run it again.".format(name, completed))
+        return(bool(completed))
+
+    def clear_phases(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM phases")
+            self.conn.execute("DELETE FROM phase_failures")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+def file_md5(fpath, manifest=None, blocksize=1048576):
+    # Get the MD5 hash of a file. If the manifest has a hash for the same size and modified time, use it instead of re-reading the file.
+    size = os.path.getsize(fpath)
+    mtime = os.path.getmtime(fpath)
+    if manifest is not None:
+        entry = manifest.get_file(fpath)
+        if entry and entry.get('size') == size and entry.get('mtime') == mtime and entry.get('md5'):
+            return(entry['md5'])
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    md5 = md5.hexdigest()
+    if manifest is not None:
+        manifest.set_file(fpath, size=size, mtime=mtime, md5=md5)
+    return(md5)
+
+def list_upload_files(xml_file, max_MBsize=2000, release=None):
+    # List all files in the XML's directory, except original xml and other bad apples.
+    # Returns files to upload and the names of files that are bigger than max_MBsize.
+    # If a ReleaseManifest is given, files and sizes are read from it.
+    datadir = os.path.dirname(xml_file)
+    if release is not None:
+        all_files = release.files('*', datadir, recursive=False)
+        getsize = release.size
+    else:
+        all_files = [os.path.join(datadir, fn) for fn in os.listdir(datadir) if os.path.isfile(os.path.join(datadir, fn))]
+        getsize = os.path.getsize
+    all_files = [fn for fn in all_files
+                 if not fn.endswith('_orig')
+                 and not fn.endswith('DS_Store')
+                 and not fn.endswith('.lock')]
+    up_files = []
+    bigfiles = []
+    for fn in all_files:
+        if getsize(fn) > max_MBsize*1000000: # convert megabytes to bytes
+            bigfiles.append(os.path.basename(fn))
+        else:
+            up_files.append(fn)
+    return(up_files, bigfiles)
+
+def list_item_files(data_item):
+    # Map the name of each file on the SB page to its size, MD5 (if SB reports it), and facet index (None if not in a facet).
+    sbfiles = {}
+    for fl_json in data_item.get('files') or []:
+        sbfiles[fl_json['name']] = (fl_json, None)
+    for fc_idx, facet in enumerate(data_item.get('facets') or []):
+        for fl_json in facet.get('files', []):
+            sbfiles[fl_json['name']] = (fl_json, fc_idx)
+    out = {}
+    for name, (fl_json, fc_idx) in sbfiles.items():
+        checksum = fl_json.get('checksum') or {}
+        md5 = checksum.get('value') if str(checksum.get('type', '')).upper() == 'MD5' else None
+        out[name] = {'size': fl_json.get('size'), 'md5': md5, 'facet': fc_idx}
+    return(out)
+
+def sync_files(sb, item, up_files, manifest=None, keep=(), verbose=False):
+    # Make the files on the SB page match up_files, uploading only new or changed files and removing files not in up_files.
+    # A file is changed if its size differs from SB, or its MD5 differs from SB's checksum (or, if SB has none, from the MD5 recorded at its last upload).
+    # Files in shapefile/raster facets can't be replaced individually, so a change to one file re-uploads the whole facet.
+    # Names in keep (e.g. files too big to upload here) are left on the page.
+    item = flexibly_get_item(sb, item)
+    sbfiles = list_item_files(item)
+    local = {os.path.basename(fp): fp for fp in up_files}
+    changed = set()
+    for name, fp in local.items():
+        sbfile = sbfiles.get(name)
+        if not sbfile or sbfile['size'] != os.path.getsize(fp):
+            changed.add(name)
+        elif sbfile['md5']:
+            if sbfile['md5'] != file_md5(fp, manifest):
+                changed.add(name)
+        elif manifest is None or (manifest.get_file(fp) or {}).get('uploaded_md5') != file_md5(fp, manifest):
+            changed.add(name)
+    deleted = set(sbfiles) - set(local) - set(keep)
+    # Whole facets are removed if any of their files changed or were deleted
+    drop_facets = {sbfiles[name]['facet'] for name in changed | deleted
+                   if name in sbfiles and sbfiles[name]['facet'] is not None}
+    changed |= {name for name, sbfile in sbfiles.items() if sbfile['facet'] in drop_facets and name in local}
+    # Remove changed and deleted files from the page
+    remove = {name for name in changed | deleted if name in sbfiles}
+    if remove:
+        item['files'] = [f for f in item.get('files', []) or [] if not f['name'] in remove]
+        item['facets'] = [fc for fc_idx, fc in enumerate(item.get('facets', []) or []) if not fc_idx in drop_facets]
+        item = sb.update_item(item)
+    to_upload = [local[name] for name in sorted(changed)]
+    if to_upload:
+        item = sb.upload_files_and_upsert_item(item, to_upload)
+        if manifest is not None:
+            for fp in to_upload:
+                manifest.set_file(fp, uploaded_md5=file_md5(fp, manifest))
+    if verbose:
+        print("SYNCED: {} uploaded, {} removed, {} unchanged on page '{}'.".format(
+            len(to_upload), len(deleted), len(local) - len(changed), item['title']))
+    return(item)
+
+def upload_files(sb, item, xml_file, max_MBsize=2000, replace=True, verbose=False, incremental=False, manifest=None, release=None,
+                 keep=()):
     # Upload all files in the directory to SB page.
-    if replace:
+    # With incremental=True, only new and changed files are uploaded and files no longer in the directory are removed (see sync_files).
+    # Names in keep (e.g. a preview image from another directory) are not removed in incremental mode.
+    if replace and not incremental:
         # Remove all files (and facets) from child page
         item = remove_all_files(sb, item, verbose)
     # List all files in directory, except original xml and other bad apples
     datadir = os.path.dirname(xml_file)
-    up_files = [os.path.join(datadir, fn) for fn in os.listdir(datadir)
-                if not fn.endswith('_orig')
-                and not fn.endswith('DS_Store')
-                and not fn.endswith('.lock')
-                and os.path.isfile(os.path.join(datadir, fn))]
-    bigfiles = []
-    for fn in up_files:
-        if os.path.getsize(fn) > max_MBsize*1000000: # convert megabytes to bytes
-            bigfiles.append(os.path.basename(fn))
-            up_files.remove(fn)
+    up_files, bigfiles = list_upload_files(xml_file, max_MBsize, release)
     # Upload all files to child page
     if verbose:
         start = datetime.now()
@@ -761,13 +1807,100 @@ def upload_files(sb, item, xml_file, max_MBsize=2000, replace=True, verbose=Fals
             print("**TO DO** File {} is too big to upload here. Please manually upload afterward.".format(bigfiles))
         elif len(bigfiles)>1:
             print("**TO DO** Files {} are too big to upload here. Please manually upload afterward.".format(bigfiles))
-    item = sb.upload_files_and_upsert_item(item, up_files) # upsert should "create or update a SB item"
+    if incremental:
+        item = sync_files(sb, item, up_files, manifest, keep=list(bigfiles) + list(keep), verbose=verbose)
+    else:
+        item = sb.upload_files_and_upsert_item(item, up_files) # upsert should "create or update a SB item"
     if verbose:
         end = datetime.now()
         duration = end - start
         print("UPLOAD COMPLETED. Duration: {}".format(duration))
     return(item, bigfiles)
 
+def upload_datapage(sb, xml_file, datapageid, new_values={}, max_MBsize=2000, imagefile=False, verbose=False,
+                    incremental=False, manifest=None, release=None):
+    # Upload all files in the XML's directory to its data page and optionally add a preview image.
+    # With incremental=True, only files that differ from those on the page are uploaded (see sync_files).
+    data_item = sb.get_item(datapageid)
+    # Update publication date in item
+    try:
+        # If pubdate in new_values, set it as the date for the SB page
+        if not data_item["dates"][0]["dateString"] == new_values['pubdate']:
+            data_item["dates"][0]["dateString"]= new_values['pubdate'] #FIXME add this to a function in a more generalized way?
+            if incremental: # the page might not otherwise be updated
+                data_item = sb.update_item(data_item)
+    except:
+        pass
+    # Upload all files in directory to the SB page; the preview image is kept so that it isn't removed and re-uploaded each run
+    keep = [os.path.basename(imagefile)] if imagefile else []
+    data_item, bigfiles = upload_files(sb, data_item, xml_file, max_MBsize=max_MBsize, replace=True, verbose=verbose,
+                                       incremental=incremental, manifest=manifest, release=release, keep=keep)
+    if imagefile:
+        if not incremental or not os.path.basename(imagefile) in list_item_files(data_item):
+            data_item = sb.upload_file_to_item(data_item, imagefile)
+    return(data_item, bigfiles)
+
+def upload_all_datapages(sb, xmllist, dict_DIRtoID, parentdir, valid_ids=None, new_values={}, max_MBsize=2000,
+                         imagefile=False, workers=1, start_idx=0, verbose=False, incremental=False, manifest=None, release=None,
+                         pages=None, username=None, password=None):
+    # Upload the data for every XML in xmllist to its page, running up to 'workers' pages at a time.
+    # With incremental=True, only changed files are uploaded; the manifest of file hashes is saved at the end.
+    # The session should be logged in before the call. If a username is given, it is logged back in if it times out during the uploads.
+    # A failed page (including one whose page ID can't be found) is reported and doesn't stop the others.
+    # dict_DIRtoID is updated in the order of xmllist regardless of the order in which uploads finish.
+    # Returns the list of files too big to upload and the list of (xml_file, error) failures.
+    total = start_idx + len(xmllist)
+    login_lock = threading.Lock()
+    def upload_page(idx, xml_file):
+        print("File {}: {}".format(start_idx + idx + 1, xml_file))
+        # Get SB page ID from the XML
+        datapageid = get_pageid_from_xmlpath(xml_file, sb=sb, dict_DIRtoID=dict_DIRtoID, valid_ids=valid_ids, parentdir=parentdir, verbose=False, pages=pages)
+        if not datapageid:
+            raise Exception("No page ID found.")
+        # Log into SB if it's timed out; one thread logs back in while the others wait
+        if username and not sb.is_logged_in():
+            with login_lock:
+                if not sb.is_logged_in():
+                    log_in(username, password, session=sb)
+        return(upload_datapage(sb, xml_file, datapageid, new_values, max_MBsize, imagefile, verbose, incremental, manifest, release))
+    results = {}
+    errors = {}
+    cnt = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for idx, xml_file in enumerate(xmllist):
+            futures[executor.submit(upload_page, idx, xml_file)] = idx
+        for future in as_completed(futures):
+            idx = futures[future]
+            cnt += 1
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                errors[idx] = e
+                print("EXCEPTION while uploading {}: {}".format(xmllist[idx], e))
+                continue
+            if isinstance(dict_DIRtoID, StateStore): # record right away; order doesn't matter in the store
+                dict_DIRtoID[xmllist[idx]] = results[idx][0]['id']
+            if verbose:
+                now_str = datetime.now().strftime("%H:%M:%S on %Y-%m-%d")
+                print('Completed {} ({} out of {} total xml files) at {}.\n'.format(os.path.basename(xmllist[idx]), start_idx+cnt, total, now_str))
+    # Merge results in list order
+    bigfiles = []
+    for idx, xml_file in enumerate(xmllist):
+        if idx in results:
+            data_item, bigfiles1 = results[idx]
+            bigfiles += bigfiles1
+            if not isinstance(dict_DIRtoID, StateStore):
+                dict_DIRtoID[xml_file] = data_item['id']
+    if manifest is not None:
+        manifest.save()
+    failures = [(xmllist[idx], errors[idx]) for idx in sorted(errors)]
+    if failures:
+        print("Upload failed for {} of {} XML files:".format(len(failures), len(xmllist)))
+        for xml_file, e in failures:
+            print("  {}: {}".format(xml_file, e))
+    return(bigfiles, failures)
+
 def upload_files_matching_xml(sb, item, xml_file, max_MBsize=2000, replace=True, verbose=False):
     # Upload all files matching the XML filename to SB page.
     # E.g. xml_file = 'path/data_name.ext.xml' will upload all files beginning with 'data_name'
@@ -855,13 +1988,13 @@ def find_browse_in_json(data_item, browse_desc=None, verbose=True):
             print('browse filename: {}'.format(browse_image))
     return(data_item, browse_image)
 
-def update_browse(sb, in_metadata, page_id, verbose=True):
+def update_browse(sb, in_metadata, page_id, verbose=True, docs=None):
     # Match the XML values with the image file on the SB page.
     # 1. Parse the XML file and get the caption.
     # 2. Find a *browse* image file in the SB page: set the 'useForPreview' to True and get the filename
     # 3. Update the browse filename and browse type in the XML.
     # Get the caption from the metadata
-    metadata_root, tree, xml_file = get_root_flexibly(in_metadata)
+    metadata_root, tree, xml_file = get_root_flexibly(in_metadata, docs)
     browse_desc = metadata_root.findall('./idinfo/browse/browsed')[0].text
     browse_desc = trunc(browse_desc, 80)
 
@@ -887,88 +2020,144 @@ def update_browse(sb, in_metadata, page_id, verbose=True):
     metadata_root.findall('./idinfo/browse/browsen')[0].text = browse_link
     metadata_root.findall('./idinfo/browse/browset')[0].text = browset
 
-    # Either overwrite XML file with new XML or return the updated metadata_root
+    # Either overwrite XML file with new XML (or mark it for writing) or return the updated metadata_root
     if type(in_metadata) is str:
-        tree.write(xml_file)
+        if docs is not None:
+            docs.mark_dirty(xml_file)
+        else:
+            tree.write(xml_file)
         print("Updated XML: {}".format(os.path.basename(xml_file)))
         return(True)
     else:
         return(metadata_root)
 
-def get_parent_bounds(sb, parent_id, verbose=False):
+def get_item_bbox(item):
+    # Bounding box of an SB item from its facets or, failing that, its spatial field; None if it has neither.
+    if item.get('facets') and 'boundingBox' in item['facets'][0]:
+        return(item['facets'][0]['boundingBox']) # {u'minX': -81.43, u'minY': 28.374, u'maxX': -80.51, u'maxY': 30.70}
+    elif 'spatial' in item and 'boundingBox' in item['spatial']:
+        return(item['spatial']['boundingBox'])
+
+def get_bounds_from_xml(in_metadata, docs=None):
+    # Bounding box from the bounding coordinates (./idinfo/spdom/bounding) of an XML file or metadata root,
+    # in the form of an SB boundingBox; None if the coordinates are missing.
+    parsed = get_root_flexibly(in_metadata, docs)
+    if not parsed:
+        return(None)
+    bounding = parsed[0].find('./idinfo/spdom/bounding')
+    if bounding is None:
+        return(None)
+    corners = {'minX': 'westbc', 'maxX': 'eastbc', 'minY': 'southbc', 'maxY': 'northbc'}
+    try:
+        return(dict([(corner, float(bounding.findtext(tag))) for corner, tag in corners.items()]))
+    except (TypeError, ValueError):
+        print("Bounding coordinates in {} are not all numbers.".format(in_metadata))
+        return(None)
+
+def get_xml_extents(xmllist, sb=None, dict_DIRtoID=None, valid_ids=None, parentdir=None, docs=None, pages=None):
+    # Dictionary of {page ID: bounding box} from the bounding coordinates in each XML file,
+    # so that parent extents can be set without waiting for SB to process the uploaded data.
+    # The boxes of several XMLs on the same page are merged. Boxes recorded by the PageIndex when it read the
+    # XMLs are used if given; other XMLs are read through docs (XmlDocCache), if given.
+    bboxes = {} # page ID: [bounding boxes]
+    found = 0
+    for xml_file in xmllist:
+        if pages is not None and os.path.abspath(xml_file) in pages.bounds:
+            bbox = pages.bounds[os.path.abspath(xml_file)]
+        else:
+            bbox = get_bounds_from_xml(xml_file, docs)
+        if not bbox:
+            continue
+        page_id = get_pageid_from_xmlpath(xml_file, sb, dict_DIRtoID, valid_ids, parentdir=parentdir, docs=docs, pages=pages)
+        if page_id:
+            bboxes.setdefault(page_id, []).append(bbox)
+            found += 1
+    extents = dict([(page_id, union_bbox(boxes)) for page_id, boxes in bboxes.items()])
+    print("Read bounding coordinates from {} of {} XML files ({} pages).".format(found, len(xmllist), len(extents)))
+    return(extents)
+
+def union_bbox(bboxes):
+    # Smallest bounding box containing all the input boxes; {} if there are none.
+    parent_bounds = {}
+    for bbox in bboxes:
+        if not parent_bounds:
+            parent_bounds = dict(bbox)
+            continue
+        for corner in parent_bounds:
+            if 'min' in corner:
+                parent_bounds[corner] = min(bbox[corner], parent_bounds[corner])
+            if 'max' in corner:
+                parent_bounds[corner] = max(bbox[corner], parent_bounds[corner])
+    return(parent_bounds)
+
+def get_parent_bounds(sb, parent_id, verbose=False, snapshot=None, extents=None):
     # UPDATED 9/6/17: added "and i < len(kids)", changed 1 to i in second loop, and added "if not parent_bounds: parent_bounds = bbox"
-    item = sb.get_item(parent_id)
-    kids = sb.get_child_ids(parent_id)
+    # If a snapshot with the 'spatial' and 'facets' fields is given, the parent and children are read from it.
+    # The parent page is only updated if its bounding box changes.
+    # Bounding boxes in extents ({page ID: bbox}) are used for pages without children in place of their SB fields.
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, parent_id, fields=('spatial', 'facets'))
+    item = snapshot.get(parent_id)
+    kids = snapshot.child_ids(parent_id)
     if len(kids) > 0:
-        # Initialize parent_bounds with first child
-        i = 0
-        found = False
-        while not found and i < len(kids): # stop when bounding box is found in item or when there are no item left to search
-            try:
-                child = sb.get_item(kids[i])
-            except:
-                i += 1
-                found = False
-            if 'facets' in child:
-                parent_bounds = child['facets'][0]['boundingBox']
-                found = True
-            elif 'spatial' in child:
-                parent_bounds = child['spatial']['boundingBox']
-                found = True
+        bboxes = []
+        for cid in kids:
+            child = snapshot.get(cid)
+            if extents and cid in extents and not snapshot.child_ids(cid):
+                bbox = extents[cid]
             else:
-                i += 1
-                print("Child item '{}'' does not have 'spatial' or 'facets' fields.".format(child['title']))
-        if len(kids) > i:
-            # Loop through kids
-            for cid in kids[i:]:
-                child = sb.get_item(cid)
-                if 'facets' in child:
-                    bbox = child['facets'][0]['boundingBox'] # {u'minX': -81.43, u'minY': 28.374, u'maxX': -80.51, u'maxY': 30.70}
-                elif 'spatial' in child:
-                    bbox = child['spatial']['boundingBox']
-                else:
-                    continue
-                if not parent_bounds: # if the first step didn't find a parent, set parent_bounds to current
-                    parent_bounds = bbox
-                for corner in parent_bounds:
-                    if 'min' in corner:
-                        parent_bounds[corner] = min(bbox[corner], parent_bounds[corner])
-                    if 'max' in corner:
-                        parent_bounds[corner] = max(bbox[corner], parent_bounds[corner])
+                bbox = get_item_bbox(child)
+            if bbox is None:
+                if not bboxes:
+                    print("Child item '{}'' does not have 'spatial' or 'facets' fields.".format(child['title']))
+                continue
+            bboxes.append(bbox)
+        parent_bounds = union_bbox(bboxes)
         # Update parent bounding box
-        if 'parent_bounds' in locals():
-            try:
-                item['spatial']['boundingBox'] = parent_bounds
-            except KeyError:
-                if parent_bounds:
-                    item['spatial'] = {}
-                    item['spatial']['boundingBox'] = parent_bounds
-            item = sb.update_item(item)
+        if parent_bounds and item.get('spatial', {}).get('boundingBox') != parent_bounds:
+            item = dict(item)
+            item['spatial'] = dict(item.get('spatial') or {})
+            item['spatial']['boundingBox'] = parent_bounds
+            item = snapshot.update(sb.update_item(item))
             if verbose:
                 print('Updated bounding box for parent "{}"'.format(item['title']))
-        else:
-            parent_bounds = {}
         return parent_bounds
 
-def get_idlist_bottomup(sb, top_id):
-    tier1 = sb.get_child_ids(top_id)
-    tier2 = []
-    for t1 in tier1:
-        tier2 += sb.get_child_ids(t1)
-    tier3 = []
-    for t2 in tier2:
-        tier3 += sb.get_child_ids(t2)
-    idlist_bottomup = tier3 + tier2 + tier1
+def get_idlist_bottomup(sb, top_id, snapshot=None):
+    # List the IDs of all pages in the tree, children before parents, ending with top_id.
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id)
+    idlist_bottomup = snapshot.walk_bottomup(top_id)
     idlist_bottomup.append(top_id)
     return idlist_bottomup
 
-def set_parent_extent(sb, top_id, verbose=False):
-    pagelist = get_idlist_bottomup(sb,top_id)
+def set_parent_extent(sb, top_id, verbose=False, snapshot=None, extents=None):
+    # Set the bounding box of every parent page to the extent of its children, at any depth.
+    # The tree is fetched once with only the spatial and facets fields and folded from the bottom up
+    # in memory, so each parent sees the updated extents of its sub-parents.
+    # Only parents whose bounding box changes are sent to SB.
+    # If extents ({page ID: bbox}, e.g. from get_xml_extents) are given, they are used for the data pages so that
+    # the parent extents don't depend on SB having processed the uploaded data.
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id, fields=('spatial', 'facets'))
+    pagelist = [page for page in get_idlist_bottomup(sb, top_id, snapshot) if snapshot.child_ids(page)]
+    updates = 0
+    parent_bounds = None
     for page in pagelist:
-        parent_bounds = get_parent_bounds(sb, page, verbose)
+        before = snapshot.get(page).get('spatial', {}).get('boundingBox')
+        parent_bounds = get_parent_bounds(sb, page, verbose, snapshot, extents)
+        if parent_bounds and parent_bounds != before:
+            updates += 1
+    print("Updated the bounding box of {} of {} parent pages.".format(updates, len(pagelist)))
     return parent_bounds
 
-def find_browse_file(datadir, searchterm='*browse*', extensions=('.png', '.jpg', '.jpeg', '.gif')):
+def find_browse_file(datadir, searchterm='*browse*', extensions=('.png', '.jpg', '.jpeg', '.gif'), release=None):
+    if release is not None:
+        browse_file = release.browse_file(datadir, searchterm)
+        if browse_file:
+            return(browse_file)
+        print("Note: No {} image files found in the directory.".format(searchterm))
+        return
     imagelist = []
     for ext in extensions:
         imagelist.extend(glob.glob(os.path.join(datadir, searchterm + ext)))
@@ -978,7 +2167,7 @@ def find_browse_file(datadir, searchterm='*browse*', extensions=('.png', '.jpg',
     print("Note: No {} image files found in the directory.".format(searchterm))
     return
 
-def upload_all_previewImages(sb, parentdir, dict_DIRtoID=False, verbose=False):
+def upload_all_previewImages(sb, parentdir, dict_DIRtoID=False, verbose=False, pages=None):
     # Upload all image files to their respective pages.
     # 1. find all image files in folder tree
     # 2. for each image, try to upload it
@@ -995,7 +2184,10 @@ def upload_all_previewImages(sb, parentdir, dict_DIRtoID=False, verbose=False):
                     item = sb.get_item(dict_DIRtoID[reldirpath])
                 except:
                     title = d # dirname should correspond to page title
-                    item = sb.find_items_by_title(title)['items'][0]
+                    if pages is not None:
+                        item = sb.get_item(pages.by_title(title, os.path.basename(root)))
+                    else:
+                        item = sb.find_items_by_title(title)['items'][0]
                 if verbose:
                     print('UPLOADING: preview image to "{}"...\n\n'.format(d))
                 item = sb.upload_file_to_item(item, f)
@@ -1108,20 +2300,28 @@ def update_existing_fields(sb, parentdir, data_inherits, subparent_inherits, fna
     print("Fields updated and values items stored in dictionary: {}".format(fname_id2json))
     return True
 
-def get_pageid_from_xmlpath(xml_file, sb=None, dict_DIRtoID=None, valid_ids=None, parentid=None, parentdir=None, verbose=False):
+def get_pageid_from_xmlpath(xml_file, sb=None, dict_DIRtoID=None, valid_ids=None, parentid=None, parentdir=None, verbose=False, docs=None, pages=None):
     # Flexibly get page_id based on XML file, either from the directory:ID dict, the SB title, or the SB citation in the XML file.
+    # If a PageIndex is given, titles and citations are looked up in it instead of searching SB, and its IDs are the valid IDs.
     page_id = None # Initialize page_id as None
+    if pages is not None and not valid_ids:
+        valid_ids = pages.ids
     # First try: try the directory:ID dictionary if provided
     if dict_DIRtoID and not page_id:
-        if xml_file in dict_DIRtoID:
-            page_id = dict_DIRtoID[xml_file]
-        elif parentdir:
+        page_id = dict_DIRtoID.get(xml_file)
+        if not page_id and parentdir:
             relpath = os.path.relpath(os.path.dirname(xml_file), os.path.dirname(parentdir))
-            if relpath in dict_DIRtoID:
-                page_id = dict_DIRtoID[relpath]
+            page_id = dict_DIRtoID.get(relpath)
+    title = os.path.basename(os.path.dirname(xml_file))
+    # Next try: look for the page matching the folder name in the page index, then the citation in the XML.
+    if not page_id and pages is not None:
+        page_id = pages.by_title(title, os.path.basename(os.path.dirname(os.path.dirname(xml_file))))
+        if not page_id:
+            page_id = pages.by_xml(xml_file)
+        if page_id and verbose:
+            print("Found page ID in the page index. Result: {}: {}".format(page_id, title))
     # Next try: if we have an SB session look for SB page matching the folder name
-    if not page_id and sb:
-        title = os.path.basename(os.path.dirname(xml_file))
+    if not page_id and sb and pages is None:
         matching_items = sb.find_items_by_title(title)['items']
         if matching_items:
             page_id = matching_items[0]['id']
@@ -1132,7 +2332,7 @@ def get_pageid_from_xmlpath(xml_file, sb=None, dict_DIRtoID=None, valid_ids=None
             # TODO: search for matching XML?
     # Next try: get the second URL in the XML citeinfo, which should always be the SB page
     if not page_id:
-        metadata_root, tree, xml_file = get_root_flexibly(xml_file)
+        metadata_root, tree, xml_file = get_root_flexibly(xml_file, docs)
         link_elems = metadata_root.findall('./idinfo/citation/citeinfo/onlink')
         if len(link_elems) > 1:
             page_url = link_elems[1].text
@@ -1149,7 +2349,7 @@ def get_pageid_from_xmlpath(xml_file, sb=None, dict_DIRtoID=None, valid_ids=None
             parentid = dict_DIRtoID[os.path.basename(parentdir)]
     if sb and parentid and not valid_ids:
         # List IDs descended from the parentdir
-        valid_ids = sb.get_ancestor_ids(parentid)
+        valid_ids = set(sb.get_ancestor_ids(parentid))
         if verbose:
             print("...got list of IDs descended from {}.".format(parentid))
     if valid_ids:
@@ -1164,26 +2364,205 @@ def get_pageid_from_xmlpath(xml_file, sb=None, dict_DIRtoID=None, valid_ids=None
 # Apply functions to entire data release page tree
 #
 ###################################################
-def delete_all_children(sb, parentid, verbose=False):
-    # Recursively delete all SB items that are descendants of the input page.
-    # Waits up to 5 seconds for the child items to be deleted.
-    exit_message = "Not sure if the process completed..."
-    cids = sb.get_child_ids(parentid)
-    for cid in cids:
+class TreeSnapshot(object):
+    # In-memory copy of the page tree below top_id with parent/child indexes.
+    # Built from paged find_items queries for all descendants of top_id, requesting only the listed fields,
+    # so that walking the tree doesn't require get_child_ids and get_item calls for every page.
+    # Writes still go to SB; pass the returned item to update() to keep the snapshot current.
+    base_fields = ('title', 'parentId', 'hasChildren')
+
+    def __init__(self, sb, top_id, fields=(), page_size=1000):
+        self.top_id = top_id
+        self.fields = sorted(set(self.base_fields) | set(fields))
+        fieldstr = ','.join(self.fields)
+        self.items = {top_id: sb.get_item(top_id, {'fields': fieldstr})}
+        self.children = {top_id: []}
+        items = sb.find_items({'filter': 'ancestorsExcludingLinks={}'.format(top_id),
+                               'fields': fieldstr, 'max': page_size})
+        while items and 'items' in items:
+            for item in items['items']:
+                self.items[item['id']] = item
+            items = sb.next(items)
+        for item_id, item in self.items.items():
+            if item_id == top_id:
+                continue
+            self.children.setdefault(item.get('parentId'), []).append(item_id)
+        self.calls = 0 # count of lookups served from memory
+
+    def __contains__(self, item_id):
+        return(item_id in self.items)
+
+    def __len__(self):
+        return(len(self.items))
+
+    def get(self, item_id):
+        self.calls += 1
+        return(self.items[item_id])
+
+    def child_ids(self, parentid):
+        self.calls += 1
+        return(list(self.children.get(parentid, [])))
+
+    def walk_topdown(self, top_id=None):
+        # List descendants of top_id, each parent before its children (same order as the old recursion)
+        top_id = self.top_id if top_id is None else top_id
+        idlist = []
+        stack = list(reversed(self.children.get(top_id, [])))
+        while stack:
+            item_id = stack.pop()
+            idlist.append(item_id)
+            stack.extend(reversed(self.children.get(item_id, [])))
+        return(idlist)
+
+    def walk_bottomup(self, top_id=None):
+        # List descendants of top_id, each child before its parent
+        top_id = self.top_id if top_id is None else top_id
+        idlist = []
+        stack = [(cid, False) for cid in reversed(self.children.get(top_id, []))]
+        while stack:
+            item_id, expanded = stack.pop()
+            if expanded:
+                idlist.append(item_id)
+            else:
+                stack.append((item_id, True))
+                stack.extend([(cid, False) for cid in reversed(self.children.get(item_id, []))])
+        return(idlist)
+
+    def update(self, item):
+        # Merge the fields of an item returned from SB into the snapshot
+        if not isinstance(item, dict) or not item.get('id') in self.items:
+            return(item)
+        stored = self.items[item['id']]
+        for field in self.fields:
+            if field in item:
+                stored[field] = item[field]
+            else:
+                stored.pop(field, None)
+        return(item)
+
+    def remove(self, item_id):
+        # Drop item and its descendants from the snapshot
+        for cid in self.walk_topdown(item_id) + [item_id]:
+            item = self.items.pop(cid, None)
+            self.children.pop(cid, None)
+            if item and item.get('parentId') in self.children and cid in self.children[item['parentId']]:
+                self.children[item['parentId']].remove(cid)
+
+class PageIndex(object):
+    # Local index of the pages in a data release, for finding page IDs without catalog-wide title searches.
+    # Holds the ID of every page below the landing page (ids, a set), the pages with each title, and the
+    # page ID given by the SB page URL (second citation onlink) in each XML that points into the release.
+    # The bounding coordinates of each XML are recorded in the same pass (bounds), for get_xml_extents.
+    def __init__(self, sb=None, landing_id=None, snapshot=None, xmllist=(), docs=None):
+        if snapshot is None:
+            snapshot = TreeSnapshot(sb, landing_id)
+        self.landing_id = snapshot.top_id
+        self.ids = set()
+        self.items = {} # id: (title, parentId)
+        self.titles = {} # title: [ids]
+        for item_id in snapshot.walk_topdown():
+            self.add(snapshot.get(item_id))
+        self.onlinks = {} # XML path: page ID
+        self.bounds = {} # XML path: bounding box or None
+        for xml_file in xmllist:
+            self.add_xml(xml_file, docs)
+
+    def __contains__(self, page_id):
+        return(page_id in self.ids)
+
+    def __len__(self):
+        return(len(self.ids))
+
+    def add(self, item):
+        # Record a page from its JSON
+        self.ids.add(item['id'])
+        self.items[item['id']] = (item.get('title'), item.get('parentId'))
+        self.titles.setdefault(item.get('title'), []).append(item['id'])
+
+    def add_xml(self, xml_file, docs=None):
+        # Record the page ID from the SB page URL in the XML, if it is a page in the release, and the XML's bounding box
         try:
-            delete_all_children(sb, cid)
+            metadata_root = (docs.get(xml_file) if docs is not None else etree.parse(xml_file)).getroot()
         except Exception as e:
-            print("EXCEPTION: {}".format(e))
-    sb.delete_items(cids)
-    ptitle = sb.get_item(parentid)['title']
-    # Wait up to 5 seconds for the child items to be deleted
-    start = datetime.now()
-    duration = 0
-    while duration < 6:
-        duration = (datetime.now() - start).seconds
-        if len(sb.get_child_ids(parentid)) < 1:
-            exit_message = "DELETED: all child items from parent page '{}.'".format(ptitle)
-            break
+            print("Exception while trying to parse XML file ({}): {}".format(xml_file, e), file=sys.stderr)
+            return
+        link_elems = metadata_root.findall('./idinfo/citation/citeinfo/onlink')
+        if len(link_elems) > 1 and link_elems[1].text:
+            page_id = os.path.basename(link_elems[1].text.strip())
+            if page_id in self.ids:
+                self.onlinks[os.path.abspath(xml_file)] = page_id
+        self.bounds[os.path.abspath(xml_file)] = get_bounds_from_xml(metadata_root)
+
+    def by_title(self, title, parent_title=None):
+        # ID of the page with the given title. If several pages have the title, prefer the one whose parent has parent_title.
+        matches = self.titles.get(title, [])
+        if len(matches) > 1 and parent_title:
+            for page_id in matches:
+                parent = self.items.get(self.items[page_id][1])
+                if parent and parent[0] == parent_title:
+                    return(page_id)
+        return(matches[0] if matches else None)
+
+    def by_xml(self, xml_file):
+        return(self.onlinks.get(os.path.abspath(xml_file)))
+
+def delete_all_children(sb, parentid, verbose=False, snapshot=None, batch_size=100, workers=4, timeout=30):
+    # Delete all SB items that are descendants of the input page, deepest pages first.
+    # All descendants are listed with one paged query (the snapshot), then each level is deleted in
+    # batches of up to batch_size IDs, with up to 'workers' batches at a time.
+    # Before each level is deleted, waits up to timeout seconds, checking with a growing delay, for SB to list
+    # no children under its pages; pages that still have children are left. The same wait is made for the parent.
+    exit_message = "Not sure if the process completed..."
+    start = time.time()
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, parentid)
+    # Group descendants by depth so that each level can be deleted once the level below it is gone
+    levels = []
+    depth = {parentid: 0}
+    for cid in snapshot.walk_topdown(parentid):
+        depth[cid] = depth[snapshot.get(cid)['parentId']] + 1
+        if len(levels) < depth[cid]:
+            levels.append([])
+        levels[depth[cid]-1].append(cid)
+    ct = 0
+    nbatches = 0
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for lvl in range(len(levels), 0, -1):
+            # Leave pages whose children could not be deleted
+            cids = [cid for cid in levels[lvl-1] if not any(c in failed for c in snapshot.child_ids(cid))]
+            # Wait for the deletions of the level below to reach the child lists of these pages
+            waiting = set([cid for cid in cids if snapshot.child_ids(cid)])
+            def emptied():
+                waiting.difference_update([cid for cid in list(waiting) if not sb.get_child_ids(cid)])
+                return(not waiting)
+            if not poll_until(emptied, timeout):
+                print("WARNING: {} page(s) at level {} still list children after {} seconds; they will not be deleted.".format(len(waiting), lvl, timeout))
+                cids = [cid for cid in cids if not cid in waiting]
+            failed.update(set(levels[lvl-1]) - set(cids))
+            batches = [cids[i:i+batch_size] for i in range(0, len(cids), batch_size)]
+            futures = dict([(executor.submit(sb.delete_items, batch), batch) for batch in batches])
+            for future in as_completed(futures):
+                nbatches += 1
+                try:
+                    future.result()
+                    ct += len(futures[future])
+                except Exception as e:
+                    print("EXCEPTION: {}".format(e))
+                    failed.update(futures[future])
+            if verbose:
+                print("Deleted level {} ({} pages).".format(lvl, len(cids)))
+    ptitle = snapshot.get(parentid)['title']
+    for cid in snapshot.child_ids(parentid):
+        if cid not in failed:
+            snapshot.remove(cid)
+    # Wait for the deletions to reach the parent's list of children
+    if poll_until(lambda: len(sb.get_child_ids(parentid)) < 1, timeout):
+        exit_message = "DELETED: all child items from parent page '{}.'".format(ptitle)
+    duration = time.time() - start
+    print("Deleted {} pages in {} batches in {:.1f} seconds ({:.1f} pages per second).".format(ct, nbatches, duration, ct / duration if duration else 0))
+    if failed:
+        print("{} pages could not be deleted.".format(len(failed)))
     return(exit_message)
 
 def remove_all_child_pages(useremail=False, landing_link=False):
@@ -1272,71 +2651,90 @@ def check_fields3(sb, item, qcfields, verbose=False):
             print("{}: {}".format(f, len(item[f])))
     return item['id']
 
-def check_fields2_topdown(sb, top_id, qcfields, deficient_pages=[], verbose=False):
-    # Given an SB ID, pass on selected fields to all descendants; doesn't look for parents
-    for cid in sb.get_child_ids(top_id):
-        citem = sb.get_item(cid)
-        deficient = check_fields2(sb, citem, qcfields, verbose)
-        deficient_pages.append(deficient)
+def check_fields2_topdown(sb, top_id, qcfields, deficient_pages=[], verbose=False, snapshot=None):
+    # Given an SB ID, check selected fields in all descendants; doesn't look for parents
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id, fields=qcfields)
+    for cid in snapshot.walk_topdown(top_id):
+        citem = snapshot.get(cid)
         try:
-            deficient_pages = check_fields2_topdown(sb, cid, qcfields, deficient_pages, verbose)
+            deficient = check_fields2(sb, citem, qcfields, verbose)
         except Exception as e:
             print("EXCEPTION: {}".format(e))
+            continue
+        deficient_pages.append(deficient)
     return deficient_pages
 
-def inherit_topdown(sb, top_id, parent_inherits, child_inherits, verbose=False):
+def inherit_topdown(sb, top_id, parent_inherits, child_inherits, verbose=False, snapshot=None):
     # Given an SB ID, pass on selected fields to all descendants
-    item = sb.get_item(top_id)
-    for cid in sb.get_child_ids(top_id):
-        citem = sb.get_item(cid)
-        # Pass on fields to the next generation
-        if not citem['hasChildren']: # child_inherits fields to youngest generation
-            inherit_SBfields(sb, citem, child_inherits, verbose)
-        else: # parent_inherits fields to all pages
-            inherit_SBfields(sb, citem, parent_inherits, verbose)
-        # Move to the next generation
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id, fields=list(parent_inherits) + list(child_inherits))
+    # Parents are visited before their children so each child inherits the already-updated parent.
+    # Only pages whose inherited fields differ from their parent's are written to SB.
+    pagelist = snapshot.walk_topdown(top_id)
+    skipped = 0
+    failed = 0
+    for cid in pagelist:
+        citem = snapshot.get(cid)
+        parent_item = snapshot.get(citem['parentId'])
         try:
-            inherit_topdown(sb, cid, parent_inherits, child_inherits, verbose)
+            # Pass on fields to the next generation
+            if not citem['hasChildren']: # child_inherits fields to youngest generation
+                newitem = inherit_SBfields(sb, citem, child_inherits, verbose, parent_item=parent_item)
+            else: # parent_inherits fields to all pages
+                newitem = inherit_SBfields(sb, citem, parent_inherits, verbose, parent_item=parent_item)
+            if newitem is citem:
+                skipped += 1
+            else:
+                snapshot.update(newitem)
         except Exception as e:
             print("EXCEPTION: {}".format(e))
+            failed += 1
+    print("Updated inherited fields on {} pages; skipped {} pages that already matched their parent.".format(len(pagelist) - skipped - failed, skipped))
+    if failed:
+        print("{} pages could not be updated.".format(failed))
     return True
 
-def apply_topdown(sb, top_id, function, verbose=False):
+def apply_topdown(sb, top_id, function, verbose=False, fields=None, snapshot=None):
     # Given an SB ID, do function to all descendants; doesn't look for parents
-    #FIXME: does it work to simply use function name as argument?
-    for cid in sb.get_child_ids(top_id):
-        citem = sb.get_item(cid)
+    # If fields are listed, function receives the snapshot item with only those fields; otherwise the full item.
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id, fields=fields or ())
+    for cid in snapshot.walk_topdown(top_id):
+        citem = snapshot.get(cid) if fields else sb.get_item(cid)
         if verbose:
             print('Applying {} to page "{}"'.format(function, citem['title']))
-        function(sb, citem)
         try:
-            apply_topdown(sb, cid, function)
+            function(sb, citem)
         except Exception as e:
             print("EXCEPTION: {}".format(e))
     return True
 
-def apply_bottomup(sb, top_id, function, verbose=False):
-    # Given an SB ID, do function to all ancestors; doesn't look for children
-    #FIXME: does it work to simply use function name as argument?
-    for cid in sb.get_child_ids(top_id):
+def apply_bottomup(sb, top_id, function, verbose=False, fields=None, snapshot=None):
+    # Given an SB ID, do function to all descendants, children before parents
+    # If fields are listed, function receives the snapshot item with only those fields; otherwise the full item.
+    if snapshot is None:
+        snapshot = TreeSnapshot(sb, top_id, fields=fields or ())
+    for cid in snapshot.walk_bottomup(top_id):
+        citem = snapshot.get(cid) if fields else sb.get_item(cid)
+        if verbose:
+            print('Applying {} to page "{}"'.format(function, citem['title']))
         try:
-            apply_bottomup(sb, cid, function, verbose)
+            function(sb, citem)
         except Exception as e:
             print("EXCEPTION: {}".format(e))
-        citem = sb.get_item(cid)
-        if verbose:
-            print('Applying {} to page "{}"'.format(function, citem['title']))
-        function(sb, citem)
     return True
 
-def restore_original_xmls(parentdir):
+def restore_original_xmls(parentdir, release=None):
     # List XML files
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    xmllist = release.xmls(parentdir) if release is not None else glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
     ct = 0
     for xml_file in xmllist:
         # Copy the file with the _orig suffix to the original filename.
         if os.path.exists(xml_file+'_orig'):
             shutil.copy(xml_file+'_orig', xml_file)
+            if release is not None:
+                release.touch(xml_file)
             ct += 1
     print("Restored {} original XML files.".format(ct))
     return
@@ -18,6 +18,7 @@ import pickle
 import sys
 sys.path.append(os.path.dirname(os.path.realpath(__file__))) # Add the script location to the system path just to make sure this works.
 from autoSB import *
+from sb_record import RecordingSbSession, ReplaySbSession
 import getpass
 
 """
@@ -92,11 +93,18 @@ delete_all_subpages = False # True to delete all child pages before running. Not
 update_XML          = False # False to save time if XML already has most up-to-date values.
 update_data         = True # False to save time if up-to-date data files have already been uploaded.
 update_extent       = False
+extent_from_xml     = False # True to compute parent extents from the bounding coordinates in the XMLs instead of waiting for SB to process the data.
 verbose             = True
 # page_per_filename   = False
 
 max_MBsize = 2000 # 2000 mb is the suggested threshold above which to use the large file uploader.
-start_xml_idx = 0 # 0 to perform for all XMLs. This is included in case a process does not complete. '25' to start upload at file 26.
+start_xml_idx = 0 # 0 to perform for all XMLs. This is included in case a process does not complete. '25' to start upload at file 26 (XMLs are counted in sorted path order; see README).
+reset_phases = False # True to run every phase again. Otherwise phases completed by an earlier run that didn't finish are skipped.
+incremental_upload = False # True to upload only new or changed files (by size and MD5 hash) instead of replacing all files on each page.
+upload_workers = 1 # Number of data pages to upload at the same time, e.g. 8. 1 to upload one page at a time.
+xml_workers = 1 # Number of processes used to update XMLs at the same time, e.g. 4. 1 to update them one at a time (always the case on Windows).
+item_cache_size = 500 # Maximum number of SB items held in memory to avoid fetching the same page repeatedly.
+xml_cache_size = 1000 # Maximum number of parsed XML files held in memory to avoid parsing the same file repeatedly.
 
 # Default False:
 add_preview_image_to_all = False # True to put first image file encountered in a directory on its corresponding page
@@ -170,11 +178,20 @@ remove_original_xml      = False  # True to remove original files saved on the f
 """
 Initialize
 """
+stash_dir = os.path.join(parentdir, '.assistants')
+
+# Optionally record the SB calls of this run, or replay a recorded run without logging in to SB (see sb_record.py).
+# sb_cassette = os.path.join(stash_dir, 'sb_cassette.jsonl')
+# sb_cassette_mode = 'record' # 'record' to save the calls, 'replay' to answer them from the cassette
+
 #%% Initialize SB session
 # password = getpass.getpass("ScienceBase password: ")
-sb = log_in(useremail, password)
-
-stash_dir = os.path.join(parentdir, '.assistants')
+if 'sb_cassette' in locals() and sb_cassette_mode == 'replay':
+    sb = ReplaySbSession(sb_cassette, root=parentdir)
+else:
+    sb = log_in(useremail, password)
+    if 'sb_cassette' in locals():
+        sb = RecordingSbSession(sb, sb_cassette, root=parentdir)
 
 #%% Find landing page
 if not "landing_id" in locals():
@@ -11,6 +11,7 @@ import datetime
 import re
 import sys
 from lxml import etree
+from find_replace import ReplacementTable
 
 #%%
 """
@@ -33,21 +34,18 @@ def replace_in_file(fname, fstr, rstr, fill='xxx'):
         f.write(s)
     return(fname)
 
-def find_replace_dfvalues(fname, df, sycode, temp_field='templated_value', verbose=True):
+def find_replace_dfvalues(fname, df, sycode, temp_field='templated_value', verbose=True, table=None):
     # Takes dataframe
+    # Pass a ReplacementTable for the sycode to avoid compiling it for every file.
     ct = 0
     # 1. Read input file
     with io.open(fname, 'r', encoding='utf-8') as f:
         s = f.read()
     # 2. Replace strings for each row in the template DF
-    for fstr, row in df.iterrows():
-        rstr = str(row.loc[sycode])
-        if not isinstance(fstr, str): # type(fstr) == 'str':
-            continue
-        if not rstr == 'nan':
-            # s = s.replace(fstr, rstr)
-            s, ct2 = re.subn(fstr, rstr, s)
-            ct += ct2
+    if table is None:
+        table = ReplacementTable(df, sycode)
+    s, counts = table.apply(s)
+    ct += sum(counts.values())
     # 2.b. Replace metadata date
     nowstr = datetime.datetime.now().strftime("%Y%m%d")
     s, ct2 = re.subn("<metd>.*</metd>", "<metd>{}</metd>".format(nowstr), s)
@@ -410,9 +408,10 @@ for sycode in valuesdf.columns:
     xmllist = rename_xmls(basedir, sycode, valuesdf, verbose=False)
     print("{}: {} XML files ".format(sycode, len(xmllist)))
     #% Run find and replace to apply to all xml files in list
+    table = ReplacementTable(valuesdf, sycode)
     for infile in xmllist:
         relpath = os.path.relpath(infile, basedir)
-        ct_fills = find_replace_dfvalues(infile, valuesdf, sycode, verbose=False)
+        ct_fills = find_replace_dfvalues(infile, valuesdf, sycode, verbose=False, table=table)
         if ct_fills > 0:
             remaining_fills = remaining_fills.append({'file':relpath, 'fill_count':ct_fills}, ignore_index=True)
 
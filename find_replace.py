@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+find_replace.py
+
+OVERVIEW: Find-and-replace helpers shared by autoSB.py and the DeepDive template scripts
+(deepdive_xmls_find_replace.py and find_replace_deepdive_xmls_vol2.py), and the process pool
+they use to spread the work across processes.
+
+ReplacementTable holds the find/replace pairs from one sycode column of the DeepDive
+template spreadsheet and applies them to a text in a single scan when that gives the same
+result as replacing each pair in turn; otherwise it replaces them in turn.
+
+REQUIRES: pandas (for the template DF passed to ReplacementTable)
+"""
+#%% Import packages
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ['overlaps', 'ReplacementTable', 'process_pool']
+
+def process_pool(workers):
+    # Process pool that forks workers, so they inherit loaded modules and settings without re-running the calling script.
+    # Returns None if workers is 1 or fork is not available (Windows); callers then run serially.
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        return(ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')))
+    return(None)
+
+def overlaps(a, b):
+    # True if a match of a and a match of b could share any characters in a string
+    if a in b or b in a:
+        return(True)
+    for n in range(1, min(len(a), len(b))):
+        if a.endswith(b[:n]) or b.endswith(a[:n]):
+            return(True)
+    return(False)
+
+class ReplacementTable(object):
+    # Find/replace pairs from one sycode column of the template DF, compiled once and applied in a single scan.
+    # Find values are regular expressions and replace values are templates, as with re.subn.
+    # The pairs are only combined into one scan if every find value is a literal (no regular expression
+    # syntax, so no groups or backreferences), no find value overlaps another, no replace value overlaps a
+    # later find value, and no replace value is a template. Otherwise the pairs are applied in turn.
+    special = '.^$*+?{}[]\\|()'
+
+    def __init__(self, df, sycode):
+        self.pairs = []
+        for fstr, rstr in zip(df.index, df[sycode]):
+            rstr = str(rstr)
+            if not isinstance(fstr, str): # type(fstr) == 'str':
+                continue
+            if not rstr == 'nan':
+                self.pairs.append((fstr, rstr))
+        self.patterns = [re.compile(fstr) for fstr, rstr in self.pairs]
+        self.combined = None
+        if len(self.pairs) > 1 and not self.chained():
+            self.lookup = dict(self.pairs)
+            self.combined = re.compile('|'.join([re.escape(fstr) for fstr, rstr in self.pairs]))
+
+    def literal(self, fstr):
+        return(bool(fstr) and not any([c in fstr for c in self.special]))
+
+    def chained(self):
+        # True if a single scan could give a different result than replacing each pair in turn
+        for i, (fstr, rstr) in enumerate(self.pairs):
+            if not self.literal(fstr) or '\\' in rstr:
+                return(True)
+            if any([overlaps(fstr, f2) or overlaps(r2, fstr) for f2, r2 in self.pairs[:i]]):
+                return(True)
+        return(False)
+
+    def apply(self, s):
+        # Returns the new text and a dictionary of {find value: number of replacements}
+        counts = dict([(fstr, 0) for fstr, rstr in self.pairs])
+        if self.combined is None:
+            for (fstr, rstr), pattern in zip(self.pairs, self.patterns):
+                s, ct = pattern.subn(rstr, s)
+                counts[fstr] += ct
+            return(s, counts)
+        def dispatch(m):
+            fstr = m.group(0)
+            counts[fstr] += 1
+            return(self.lookup[fstr])
+        s = self.combined.sub(dispatch, s)
+        return(s, counts)
@@ -11,6 +11,7 @@ from datetime import datetime
 import re
 import sys
 from lxml import etree
+from find_replace import ReplacementTable, process_pool
 
 #%%
 """
@@ -33,23 +34,21 @@ def replace_in_file(fname, fstr, rstr, fill='xxx'):
         f.write(s)
     return(fname)
 
-def find_replace_dfvalues(fname, df, sycode, temp_field='templated_value', verbose=True):
+def find_replace_dfvalues(fname, df, sycode, temp_field='templated_value', verbose=True, table=None):
     # Takes dataframe
+    # Pass a ReplacementTable for the sycode to avoid compiling it for every file.
     ct = 0
     # 1. Read input file
     with io.open(fname, 'r', encoding='utf-8') as f:
         s = f.read()
     # 2. Replace strings for each row in the template DF
-    for fstr, row in df.iterrows():
-        rstr = str(row.loc[sycode])
-        if not isinstance(fstr, str): # type(fstr) == 'str':
-            continue
-        if not rstr == 'nan':
-            if verbose:
-                print("Replace '{}' with '{}'".format(fstr, rstr))
-            # s = s.replace(fstr, rstr)
-            s, ct2 = re.subn(fstr, rstr, s)
-            ct += ct2
+    if table is None:
+        table = ReplacementTable(df, sycode)
+    s, counts = table.apply(s)
+    for fstr, rstr in table.pairs:
+        if verbose:
+            print("Replace '{}' with '{}': {}".format(fstr, rstr, counts[fstr]))
+    ct += sum(counts.values())
     # 2.b. Replace metadata date
     nowstr = datetime.now().strftime("%Y%m%d")
     s, ct2 = re.subn("<metd>.*</metd>", "<metd>{}</metd>".format(nowstr), s)
@@ -93,8 +92,11 @@ def replace_in_filelist(searchpath, findstr, replacestr):
         # Wrap up
         print("{}: {} value(s) replaced; {} 'xxx' value(s) remaining".format(os.path.basename(fp), ct, ct_fills))
 
-def copytree(src, dst, symlinks=False, ignore=None):
+def copytree(src, dst, symlinks=False, ignore=None, skip=()):
+    # Copy the contents of src into dst, except the top-level items named in skip
     for item in os.listdir(src):
+        if item in skip:
+            continue
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if os.path.isdir(s):
@@ -149,6 +151,63 @@ def rename_xmls(basedir, sycode, valuesdf, verbose=True):
         print("There are {} XML files in {}. ".format(len(xmllist), os.path.join(basedir, sycode)))
     return(xmllist)
 
+def template_outname(fname, sycode, valuesdf):
+    # Name of the template file for the site-year, following the same rules as rename_xmls()
+    sycode_elev = valuesdf.at['xxx-elev siteyear code-xxx', sycode]
+    sycode_hab = valuesdf.at['xxx-hab siteyear code-xxx', sycode]
+    for fstr, rstr in (("xxxx", sycode), ("X{4}", sycode_hab), ("X{3}", sycode_elev)):
+        fname_out, ct = re.subn(fstr, rstr, fname)
+        if ct == 1:
+            return(fname_out)
+    return(fname)
+
+def read_templates(template_dir):
+    # Read each template XML once. Returns {filename: text}.
+    templates = {}
+    for fp in sorted(glob.glob(os.path.join(template_dir, '*.xml'))):
+        with io.open(fp, 'r', encoding='utf-8') as f:
+            templates[os.path.basename(fp)] = f.read()
+    return(templates)
+
+def render_templates(job):
+    # Fill every template with the values for one sycode and write the results to the sycode directory
+    # under their site-year names. Does the work of copytree, rename_xmls, and find_replace_dfvalues
+    # without writing each file more than once.
+    # Other XMLs already at the top of the sycode directory are renamed and filled too, as rename_xmls and
+    # find_replace_dfvalues did; those whose site-year name is taken by a template are replaced by the template.
+    # Returns the sycode, a list of (relative path, remaining fill count) for the files written, and any error.
+    templates, basedir, sycode, valuesdf = job
+    filled = []
+    try:
+        table = ReplacementTable(valuesdf, sycode)
+        nowstr = datetime.now().strftime("%Y%m%d")
+        def fill(s, fp):
+            s, counts = table.apply(s)
+            # Replace metadata date
+            s = re.sub("<metd>.*</metd>", "<metd>{}</metd>".format(nowstr), s)
+            # Count remaining xxx values
+            ct_fills = len(re.findall('(?i)xxx', s))
+            with io.open(fp, 'w', encoding='utf-8') as f:
+                f.write(s)
+            filled.append((os.path.relpath(fp, basedir), ct_fills))
+        written = set()
+        for fname, s in templates.items():
+            fp = os.path.join(basedir, sycode, template_outname(fname, sycode, valuesdf))
+            fill(s, fp)
+            written.add(fp)
+        for fp in sorted(glob.glob(os.path.join(basedir, sycode, '*.xml'))):
+            if fp in written:
+                continue
+            fp_out = os.path.join(basedir, sycode, template_outname(os.path.basename(fp), sycode, valuesdf))
+            if not fp_out in written:
+                with io.open(fp, 'r', encoding='utf-8') as f:
+                    fill(f.read(), fp_out)
+            if not fp_out == fp:
+                os.remove(fp)
+    except Exception as e:
+        return(sycode, filled, "{}: {}".format(type(e).__name__, e))
+    return(sycode, filled, None)
+
 def rename_sycode_dirs(basedir, valuesdf, code2name=True):
     # Rename from the full name to the code or vice versa
     # Map the sycodes to the full names
@@ -527,6 +586,7 @@ csvfname = "metadata values - DD vol2 - Sheet1.csv"
 csvfpath = os.path.join(basedir, csvfname)
 browsedir = r'/Volumes/stor/Projects/DeepDive/5_datarelease_packages/vol2/browse'
 sb_dir = basedir+'_forSB'
+render_workers = 1 # Number of processes used to fill the templates for the site-years, e.g. 4. 1 to fill them one at a time (always the case on Windows).
 
 #%% Save copy of csv file (templating spreadsheet) in backup dir
 backup_prerun = os.path.join(backup_dir, '{}_prerun'.format(datetime.now().strftime("%Y%m%d")))
@@ -541,23 +601,35 @@ valuesdf = pd.read_csv(csvfpath, header=0, index_col='templated_value', dtype='s
 rename_sycode_dirs(basedir, valuesdf, False)
 
 #%% Run the process -
-# For every site-year, copy and rename the template files, then replace the fill values from the spreadsheet
+# For every site-year, fill the templates with the values from the spreadsheet and write them under the site-year names.
+# XMLs already in the site-year directory are renamed and filled as well.
+# Templates are read once and the site-years are spread across render_workers processes.
 perform_backup = True
-remaining_fills = pd.DataFrame(columns=['file', 'fill_count'])
+templates = read_templates(template_dir)
+jobs = []
 for sycode in valuesdf.columns:
-    # Back up existing XML files and copy template
+    if not os.path.exists(os.path.join(basedir, sycode)):
+        print("The '{}' directory isn't present in the basedir.".format(sycode))
+        continue
+    # Back up existing XML files
     backup_xmls(basedir, sycode, backup_prerun, perform_backup, verbose=False)
-    # Copy template files into sycode directory
-    copytree(template_dir, os.path.join(basedir, sycode))
-    # Rename template XMLs to match the site-year.
-    xmllist = rename_xmls(basedir, sycode, valuesdf, verbose=False)
-    print("{}: {} XML files ".format(sycode, len(xmllist)))
-    #% Run find and replace to apply to all xml files in list
-    for infile in xmllist:
-        relpath = os.path.relpath(infile, basedir)
-        ct_fills = find_replace_dfvalues(infile, valuesdf, sycode, verbose=False)
-        if ct_fills > 0:
-            remaining_fills = remaining_fills.append({'file':relpath, 'fill_count':ct_fills}, ignore_index=True)
+    # Copy any other template files into sycode directory
+    copytree(template_dir, os.path.join(basedir, sycode), skip=templates)
+    jobs.append((templates, basedir, sycode, valuesdf[[sycode]]))
+pool = process_pool(render_workers)
+if pool is None:
+    results = [render_templates(job) for job in jobs]
+else:
+    with pool:
+        results = list(pool.map(render_templates, jobs))
+fill_rows = []
+for sycode, filled, error in results:
+    if error:
+        print("{}: FAILED to fill templates: {}".format(sycode, error))
+        continue
+    print("{}: {} XML files ".format(sycode, len(filled)))
+    fill_rows += [row for row in filled if row[1] > 0]
+remaining_fills = pd.DataFrame(fill_rows, columns=['file', 'fill_count'])
 
 print("{} files still have fill values:".format(len(remaining_fills)))
 print(remaining_fills)
@@ -39,6 +39,12 @@ from config_autoSB import *
 """
 sb = log_in(useremail)
 """
+# Time each phase of the run and count the SB calls made in it; the report is printed and saved at the end.
+run_report = RunReport()
+run_report.start_phase('landing page')
+# Share one cache of SB items across all logins so that repeated get_item calls don't go back to SB
+item_cache = ItemCache(item_cache_size if 'item_cache_size' in locals() else 500)
+sb = CachedSbSession(InstrumentedSbSession(sb, run_report), item_cache)
 # get JSON item for parent page
 landing_item = sb.get_item(landing_id)
 #print("CITATION: {}".format(landing_item['citation'])) # print to QC citation
@@ -63,6 +69,7 @@ Work with landing page and XML
 if delete_all_subpages:
     if not update_subpages:
         print('WARNING: You chose not to update subpages, but also to delete all child pages. Both are not possible so we will remove and create them.')
+    run_report.start_phase('delete_all_children')
     print("Deleting all child pages of landing page...")
     print(delete_all_children(sb, landing_id))
     # Try new get_ancestor_ids() and delete_items() to remove all children
@@ -89,8 +96,13 @@ else:
 """
 Change folder name to match XML title
 """
+# Inventory the data release tree once; each phase lists its files from the manifest.
+run_report.start_phase('rename_dirs_from_xmls')
+release = ReleaseManifest(parentdir)
+# Parse each XML once; changed XMLs are written at the end of each phase.
+xml_docs = XmlDocCache(xml_cache_size if 'xml_cache_size' in locals() else 1000)
 print('\n---\nRenaming folders to match XML title...')
-rename_dirs_from_xmls(parentdir)
+rename_dirs_from_xmls(parentdir, release=release, docs=xml_docs)
 
 #%% Create SB page structure
 """
@@ -99,24 +111,28 @@ Inputs: parent directory, landing page ID
 This one should overwrite the entire data release (excluding the landing page).
 """
 # Log into SB if it's timed out
-sb = log_in(useremail, password)
-mapfile_dir2id = os.path.join(stash_dir, 'dir_to_id.json')
-os.makedirs(os.path.dirname(mapfile_dir2id), exist_ok=True)
+run_report.start_phase('setup_subparents')
+sb = log_in(useremail, password, cache=item_cache, session=sb)
+# Page IDs, file hashes, and completed phases are stored in a SQLite file in stash_dir, saved as the work happens.
+# It behaves like the dictionary of directory and XML paths to page IDs (dict_DIRtoID).
+state = StateStore(os.path.join(stash_dir, 'state.sqlite'), parentdir)
+dict_DIRtoID = state
+# Phases completed by an earlier run that didn't finish are skipped, unless reset_phases is True.
+if 'reset_phases' in locals() and reset_phases:
+    state.clear_phases()
 
-# If there's no id_to_json.json file available, we need to create the subpage structure.
-if not update_subpages and not os.path.isfile(mapfile_dir2id):
-    print("dir_to_id.json file is not in parent directory, so we will perform update_subpages routine.")
+# If there are no stored page IDs, we need to create the subpage structure.
+if not update_subpages and not len(state):
+    print("No page IDs are stored in {}, so we will perform update_subpages routine.".format(state.dbpath))
     update_subpages = True
 
-if update_subpages:
+if update_subpages and not state.skip_phase('setup_subparents'):
     print('\n---\nCreating sub-pages...')
-    dict_DIRtoID = setup_subparents(sb, parentdir, landing_id, imagefile)
-    # Save dictionaries
-    with open(mapfile_dir2id, 'w') as f:
-        json.dump(dict_DIRtoID, f)
-else: # Import pre-created dictionaries if all SB pages exist
-    with open(mapfile_dir2id, 'r') as f:
-        dict_DIRtoID = json.load(f)
+    # New pages mean every later phase has to run again.
+    state.clear()
+    state.clear_phases()
+    setup_subparents(sb, parentdir, landing_id, imagefile, dict_DIRtoID=state, release=release)
+    state.mark_phase('setup_subparents')
 
 #%% Create and populate data pages
 """
@@ -125,20 +141,28 @@ Inputs: parent directory, landing page ID, dictionary of new values (new_values)
 For each XML file in each directory, create a data page, revise the XML, and upload the data to the new page
 """
 print('\n---\nWorking with XML files...')
+run_report.start_phase('page index')
 # Log into SB if it's timed out
-sb = log_in(useremail, password)
-valid_ids = sb.get_ancestor_ids(landing_id)
+sb = log_in(useremail, password, cache=item_cache, session=sb)
+# Index the pages below the landing page (and the page URLs in the XMLs) to look up page IDs without searching SB.
+pages = PageIndex(sb, landing_id, xmllist=release.xmls(), docs=xml_docs)
+valid_ids = pages.ids
 
 #%% Work with XMLs
+run_report.start_phase('update_all_xmls')
+# If an earlier run updated the XMLs, or some of them, the originals are left alone so the updates aren't undone.
+xmls_pending = not state.skip_phase('update_all_xmls')
+retry_xmls = state.phase_failures('update_all_xmls') if xmls_pending else []
 # Optionally remove or restore original XML files.
-if remove_original_xml:
-    print('Removing all .xml_orig files in {} tree.'.format(os.path.basename(parentdir)))
-    remove_files(parentdir, pattern='**/*.xml_orig')
-elif restore_original_xml:
-    if not update_XML:
-        print('WARNING: You selected to restore original XMLs, but not to update XMLs. This may cause problems.')
-    restore_original_xmls(parentdir)
-    print('Restored .xml_orig files in {} tree.'.format(os.path.basename(parentdir)))
+if xmls_pending and not retry_xmls:
+    if remove_original_xml:
+        print('Removing all .xml_orig files in {} tree.'.format(os.path.basename(parentdir)))
+        remove_files(parentdir, pattern='**/*.xml_orig', release=release)
+    elif restore_original_xml:
+        if not update_XML:
+            print('WARNING: You selected to restore original XMLs, but not to update XMLs. This may cause problems.')
+        restore_original_xmls(parentdir, release=release)
+        print('Restored .xml_orig files in {} tree.'.format(os.path.basename(parentdir)))
 
 # add DOI to be updated in XML
 if 'dr_doi' in locals():
@@ -146,90 +170,108 @@ if 'dr_doi' in locals():
 else:
     new_values['doi'] = get_DOI_from_item(flexibly_get_item(sb, landing_id))
 
-# Optionally update all XML files from SB values
-if update_XML:
-    update_all_xmls(parentdir, new_values, sb, dict_DIRtoID, verbose=True)
+# Optionally update all XML files from SB values; after a run in which some XMLs failed, only those are updated.
+if update_XML and xmls_pending:
+    if retry_xmls:
+        print('Updating the {} XML files that failed in the earlier run.'.format(len(retry_xmls)))
+    failed_xmls = update_all_xmls(parentdir, new_values, sb, dict_DIRtoID, verbose=True, release=release, docs=xml_docs, pages=pages,
+                                  workers=xml_workers if 'xml_workers' in locals() else 1, xmllist=retry_xmls or None)
+    state.end_phase('update_all_xmls', [xml_file for xml_file, e in failed_xmls])
 
 #%% Upload data
-if update_data:
+if update_data and not state.skip_phase('upload_data'):
+    run_report.start_phase('upload_all_datapages')
     # For each XML file in each directory, upload the data to the new page
     if verbose:
         print('\n---\nWalking through XML files to upload the data...')
-    cnt = 0
-    xmllist = glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True)
+    xmllist = release.xmls()
     xmllist = xmllist[start_xml_idx:]
-    for xml_file in xmllist:
-        cnt += 1
-        print("File {}: {}".format(cnt + start_xml_idx, xml_file))
-        # Get SB page ID from the XML
-        datapageid = get_pageid_from_xmlpath(xml_file, sb=sb, dict_DIRtoID=dict_DIRtoID, valid_ids=valid_ids, parentdir=parentdir, verbose=False)
-        # Log into SB if it's timed out
-        sb = log_in(useremail, password)
-        data_item = sb.get_item(datapageid)
-        # Upload data to ScienceBase
-        # Update publication date in item
-        try:
-            # If pubdate in new_values, set it as the date for the SB page
-            data_item["dates"][0]["dateString"]= new_values['pubdate'] #FIXME add this to a function in a more generalized way?
-        except:
-            pass
-        # Upload all files in directory to the SB page
-        data_item, bigfiles1 = upload_files(sb, data_item, xml_file, max_MBsize=max_MBsize, replace=True, verbose=verbose)
-        # Record files that were not uploaded because they were above the max_MBsize threshold
-        if bigfiles1:
-            if not 'bigfiles' in locals():
-                bigfiles = []
-            bigfiles += bigfiles1
-        # Log into SB if it's timed out
-        sb = log_in(useremail, password)
-        if 'previewImage' in data_inherits and "imagefile" in locals():
-            data_item = sb.upload_file_to_item(data_item, imagefile)
-        if verbose:
-            now_str = datetime.now().strftime("%H:%M:%S on %Y-%m-%d")
-            print('Completed {} out of {} total xml files at {}.\n'.format(start_xml_idx+cnt, start_xml_idx+len(xmllist), now_str))
-        # store values in dictionaries
-        dict_DIRtoID[xml_file] = data_item['id']
+    # After a run in which some uploads failed, only those pages are uploaded.
+    retry_uploads = state.phase_failures('upload_data')
+    if retry_uploads:
+        print('Uploading the {} XML files that failed in the earlier run.'.format(len(retry_uploads)))
+        xmllist = retry_uploads
+    # Log into SB if it's timed out; upload_all_datapages also logs back in before each page if needed
+    sb = log_in(useremail, password, cache=item_cache, session=sb)
+    page_image = imagefile if 'previewImage' in data_inherits and "imagefile" in locals() else False
+    # Optionally upload only the files that have changed since the last upload, tracked by the file hashes in the state store.
+    incremental = incremental_upload if 'incremental_upload' in locals() else False
+    # Upload pages concurrently; dict_DIRtoID is updated in the order of xmllist
+    bigfiles, failed_uploads = upload_all_datapages(sb, xmllist, dict_DIRtoID, parentdir, valid_ids=valid_ids,
+        new_values=new_values, max_MBsize=max_MBsize, imagefile=page_image,
+        workers=upload_workers if 'upload_workers' in locals() else 1, start_idx=0 if retry_uploads else start_xml_idx, verbose=verbose,
+        incremental=incremental, manifest=state, release=release, pages=pages, username=useremail, password=password)
+    state.end_phase('upload_data', [xml_file for xml_file, e in failed_uploads])
 
 print("\n---\nRunning universal updates (browse graphics and udpated XMls)...")
 
 # Preview Image
 if add_preview_image_to_all:
-    upload_all_previewImages(sb, parentdir, dict_DIRtoID)
+    run_report.start_phase('upload_all_previewImages')
+    upload_all_previewImages(sb, parentdir, dict_DIRtoID, pages=pages)
 
 #%% Update SB preview image from the uploaded files.
-if update_XML:
-    sb = log_in(useremail, password)
-    update_all_browse_graphics(sb, parentdir, landing_id, valid_ids)
+if update_XML and not state.skip_phase('update_all_browse_graphics'):
+    run_report.start_phase('update_all_browse_graphics')
+    sb = log_in(useremail, password, cache=item_cache, session=sb)
+    # Changed XMLs are uploaded once, with the other changes, in the next step.
+    browse_xmls = update_all_browse_graphics(sb, parentdir, landing_id, valid_ids, release=release, docs=xml_docs, pages=pages, upload=False)
+    state.mark_phase('update_all_browse_graphics')
 
-#%% Check for and upload XMLs that have been modified since last upload.
-sb = log_in(useremail, password)
-upload_all_updated_xmls(sb, parentdir, valid_ids)
+#%% Check for and upload XMLs that differ from the XMLs on SB.
+if not state.skip_phase('upload_all_updated_xmls'):
+    run_report.start_phase('upload_all_updated_xmls')
+    sb = log_in(useremail, password, cache=item_cache, session=sb)
+    xml_uploads, xml_matched = upload_all_updated_xmls(sb, parentdir, valid_ids, release=release, pages=pages, manifest=state)
+    state.mark_phase('upload_all_updated_xmls')
 
 #%% Pass down fields from parents to children
-print("\n---\nPassing down fields from parents to children...")
-inherit_topdown(sb, landing_id, subparent_inherits, data_inherits, verbose=verbose)
+if not state.skip_phase('inherit_topdown'):
+    print("\n---\nPassing down fields from parents to children...")
+    run_report.start_phase('inherit_topdown')
+    inherit_topdown(sb, landing_id, subparent_inherits, data_inherits, verbose=verbose)
+    state.mark_phase('inherit_topdown')
 
 #%% BOUNDING BOX
-if update_extent:
+if update_extent and not state.skip_phase('set_parent_extent'):
+    run_report.start_phase('set_parent_extent')
     print("\nGetting extent of child data for parent pages...")
-    set_parent_extent(sb, landing_id, verbose=verbose)
-
-# Save dictionaries
-with open(mapfile_dir2id, 'w') as f:
-    json.dump(dict_DIRtoID, f)
+    # Optionally take the data page extents from the bounding coordinates in the XMLs instead of the SB facets.
+    extents = None
+    if 'extent_from_xml' in locals() and extent_from_xml:
+        extents = get_xml_extents(release.xmls(), sb, dict_DIRtoID, valid_ids, parentdir=parentdir, docs=xml_docs, pages=pages)
+    set_parent_extent(sb, landing_id, verbose=verbose, extents=extents)
+    state.mark_phase('set_parent_extent')
 
 #%% QA/QC
 if 'qcfields_dict' in locals():
+    run_report.start_phase('check_fields')
     qcfields_dict = {'contacts':7, 'webLinks':0, 'facets':1}
     print('Checking that each page has: \n{}'.format(qcfields_dict))
     pagelist = check_fields2_topdown(sb, landing_id, qcfields_dict, verbose=False)
 
+run_report.end_phase()
+# The run finished, so the next run starts again from the first phase.
+state.clear_phases()
 now_str = datetime.now().strftime("%H:%M:%S on %m/%d/%Y")
 print('\n{}\nAll done! View the result at {}'.format(now_str, landing_link))
+print(item_cache.report())
+print(xml_docs.report())
+if 'xml_uploads' in locals():
+    print("XML uploads: {} in the final check; {} skipped because SB already had the same XML{}.".format(xml_uploads, xml_matched,
+          "; {} browse graphic changes included".format(browse_xmls) if 'browse_xmls' in locals() else ''))
 if 'bigfiles' in locals():
     if len(bigfiles) > 0:
         print("These files were too large to upload so you'll need to use the large file uploader:")
         print(*bigfiles, sep = "\n")
+if 'failed_uploads' in locals():
+    if len(failed_uploads) > 0:
+        print("Uploads failed for these XML files so you'll need to rerun them:")
+        print(*[xml_file for xml_file, e in failed_uploads], sep = "\n")
+if 'failed_xmls' in locals():
+    if len(failed_xmls) > 0:
+        print("These XML files could not be updated:")
+        print(*["{}: {}".format(xml_file, e) for xml_file, e in failed_xmls], sep = "\n")
 
 #%% Backup the XMLs resulting from SB upload
 today = datetime.now().strftime("%Y%m%d")
@@ -239,3 +281,7 @@ print('Saving output XMLs to {}'.format(xmlstash))
 for fp in glob.glob(os.path.join(parentdir, '[!x]*/**/*.[xX][mM][lL]')):
     shutil.copy(fp, xmlstash)
 shutil.make_archive(xmlstash, 'zip', xmlstash)
+
+#%% Report the time and SB calls of each phase and save them for comparison with other runs.
+print(run_report.summary())
+print('Saved run report to {}'.format(run_report.save(os.path.join(stash_dir, 'run_reports', 'run_{}.json'.format(run_report.started.strftime("%Y%m%d_%H%M%S"))))))
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+sb_fake.py
+
+OVERVIEW: In-memory stand-in for a ScienceBase (SB) session and generators for synthetic
+data releases, to run and time the autoSB.py routines at scale without connecting to SB.
+
+FakeSbSession implements the part of the sciencebasepy SbSession API that autoSB.py uses.
+Items, parent links, files, facets, and spatial fields are kept in dictionaries, with an
+index of children by parent so that tree queries don't scan every item. Each call can be
+slowed by a fixed latency (or one per method) and made to fail at a given rate.
+Uploaded shapefiles become a facet with the bounding box of the XML uploaded with them,
+as SB does once it has processed the files.
+
+make_release() writes a directory tree of FGDC XMLs (with a browse graphic and a small
+data file for each) and make_page_tree() builds a matching tree of pages directly in a
+FakeSbSession. fgdc_xml() returns the text of one XML, optionally with large entity and
+attribute blocks.
+
+REQUIRES: lxml (for the bounding box of uploaded XMLs)
+"""
+#%% Import packages
+import os
+import copy
+import time
+import random
+import hashlib
+import threading
+from datetime import datetime
+from lxml import etree
+
+__all__ = ['FakeSbSession', 'fgdc_xml', 'make_release', 'make_page_tree']
+
+class FakeSbSession(object):
+    # Dictionary-backed SbSession for scale testing.
+    # latency is the seconds added to each call: a number or a dictionary of {method: seconds}.
+    # failure_rate is the fraction of calls that raise an Exception, drawn from a random generator seeded with seed.
+    # calls counts the calls to each method.
+    url = 'https://www.sciencebase.gov/catalog/item/{}'
+
+    def __init__(self, latency=0, failure_rate=0, seed=0, page_size=20):
+        self.items = {}
+        self.children = {} # parent ID: [child IDs]
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.page_size = page_size
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._ids = 0
+        self._lock = threading.RLock()
+
+    def _call(self, method):
+        # Count the call, wait the latency, and fail at the failure rate
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = self.failure_rate and self._random.random() < self.failure_rate
+        seconds = self.latency.get(method, 0) if isinstance(self.latency, dict) else self.latency
+        if seconds:
+            time.sleep(seconds)
+        if fail:
+            raise Exception("Simulated SB failure in {}".format(method))
+
+    def _new_id(self):
+        with self._lock:
+            self._ids += 1
+            return('{:024x}'.format(self._ids))
+
+    def _json(self, item, fields=None):
+        # Copy of the stored item as SB returns it, optionally with only the listed fields
+        out = copy.deepcopy(item)
+        out['hasChildren'] = bool(self.children.get(item['id']))
+        if fields:
+            keep = set(fields.split(',')) | set(['id'])
+            out = dict([(k, v) for k, v in out.items() if k in keep])
+        return(out)
+
+    def _descendants(self, item_id):
+        idlist = []
+        stack = list(self.children.get(item_id, []))
+        while stack:
+            cid = stack.pop()
+            idlist.append(cid)
+            stack.extend(self.children.get(cid, []))
+        return(idlist)
+
+    def _page(self, idlist, fields, offset, size):
+        # One page of find_items results; 'nextlink' holds what next() needs to get the following page
+        result = {'total': len(idlist), 'items': [self._json(self.items[i], fields) for i in idlist[offset:offset+size]]}
+        if offset + size < len(idlist):
+            result['nextlink'] = {'ids': idlist, 'fields': fields, 'offset': offset + size, 'max': size}
+        return(result)
+
+    #%% Session
+    def is_logged_in(self):
+        return(True)
+
+    #%% Reading items
+    def get_item(self, itemid, params=None):
+        self._call('get_item')
+        with self._lock:
+            if not itemid in self.items:
+                raise Exception("Item not found: {}".format(itemid))
+            return(self._json(self.items[itemid], (params or {}).get('fields')))
+
+    def get_child_ids(self, parentid):
+        self._call('get_child_ids')
+        with self._lock:
+            return(list(self.children.get(parentid, [])))
+
+    def get_ancestor_ids(self, parentid):
+        # Like sciencebasepy, lists the descendants of parentid
+        self._call('get_ancestor_ids')
+        with self._lock:
+            return(self._descendants(parentid))
+
+    def find_items(self, params):
+        # Supports the parentIdExcludingLinks and ancestorsExcludingLinks filters and the q (title) search
+        self._call('find_items')
+        with self._lock:
+            if 'filter' in params:
+                key, value = params['filter'].split('=', 1)
+                if key in ('parentId', 'parentIdExcludingLinks'):
+                    idlist = list(self.children.get(value, []))
+                elif key in ('ancestors', 'ancestorsExcludingLinks'):
+                    idlist = self._descendants(value)
+                else:
+                    raise ValueError("Filter {} is not supported by FakeSbSession.".format(key))
+            else:
+                idlist = [i for i, item in self.items.items() if item.get('title') == params.get('q')]
+            return(self._page(idlist, params.get('fields'), int(params.get('offset', 0)), int(params.get('max', self.page_size))))
+
+    def find_items_by_title(self, text):
+        return(self.find_items({'q': text}))
+
+    def next(self, items):
+        self._call('next')
+        if not items or not 'nextlink' in items:
+            return(None)
+        link = items['nextlink']
+        with self._lock:
+            idlist = [i for i in link['ids'] if i in self.items]
+            return(self._page(idlist, link['fields'], link['offset'], link['max']))
+
+    #%% Writing items
+    def create_item(self, item_json):
+        self._call('create_item')
+        return(self._create(item_json))
+
+    def create_items(self, items_json):
+        self._call('create_items')
+        return([self._create(item_json) for item_json in items_json])
+
+    def _create(self, item_json):
+        with self._lock:
+            parentid = item_json.get('parentId')
+            if parentid and not parentid in self.items:
+                raise Exception("Parent item not found: {}".format(parentid))
+            item = copy.deepcopy(item_json)
+            item['id'] = self._new_id()
+            item.setdefault('title', '')
+            item['link'] = {'rel': 'self', 'url': self.url.format(item['id'])}
+            item.pop('hasChildren', None)
+            self.items[item['id']] = item
+            self.children[item['id']] = []
+            if parentid:
+                self.children[parentid].append(item['id'])
+            return(self._json(item))
+
+    def update_item(self, item_json):
+        self._call('update_item')
+        return(self._update(item_json))
+
+    def update_items(self, items_json):
+        self._call('update_items')
+        return([self._update(item_json) for item_json in items_json])
+
+    def _update(self, item_json):
+        with self._lock:
+            if not item_json.get('id') in self.items:
+                raise Exception("Item not found: {}".format(item_json.get('id')))
+            item = self.items[item_json['id']]
+            if item_json.get('parentId', item.get('parentId')) != item.get('parentId'):
+                self.children[item['parentId']].remove(item['id'])
+                self.children[item_json['parentId']].append(item['id'])
+            for field, value in item_json.items():
+                if not field in ('id', 'hasChildren', 'link'):
+                    item[field] = copy.deepcopy(value)
+            return(self._json(item))
+
+    def delete_item(self, item_json):
+        self._call('delete_item')
+        return(self._delete(item_json['id']))
+
+    def delete_items(self, itemIds):
+        self._call('delete_items')
+        return([self._delete(i) for i in itemIds])
+
+    def _delete(self, item_id):
+        # Like SB, a page with children can't be deleted
+        with self._lock:
+            if self.children.get(item_id):
+                raise Exception("Item {} has children and can't be deleted.".format(item_id))
+            item = self.items.pop(item_id)
+            self.children.pop(item_id, None)
+            if item.get('parentId') in self.children:
+                self.children[item['parentId']].remove(item_id)
+            return(True)
+
+    #%% Files
+    def _file_json(self, filename):
+        with open(filename, 'rb') as f:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        name = os.path.basename(filename)
+        is_xml = name.lower().endswith('.xml')
+        return({'name': name, 'size': os.path.getsize(filename),
+                'contentType': 'application/fgdc+xml' if is_xml else 'application/octet-stream',
+                'originalMetadata': is_xml, 'checksum': {'value': md5, 'type': 'MD5'},
+                'dateUploaded': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+    def _add_files(self, item_id, filenames):
+        # Add or replace files on the stored item. A shapefile and the files that share its name are moved
+        # into a facet with the bounding box from the XML uploaded with them.
+        with self._lock:
+            item = self.items[item_id]
+            files = [f for f in item.get('files') or [] if not f['name'] in [os.path.basename(fn) for fn in filenames]]
+            files += [self._file_json(fn) for fn in filenames]
+            bbox = None
+            for fn in filenames:
+                if fn.lower().endswith('.xml'):
+                    bbox = _xml_bbox(fn) or bbox
+            for shp in [f['name'] for f in files if f['name'].lower().endswith('.shp')]:
+                stem = shp[:-4]
+                facet_files = [f for f in files if f['name'].startswith(stem + '.') and not f['name'].lower().endswith('.xml')]
+                files = [f for f in files if not f in facet_files]
+                facet = {'className': 'gov.sciencebase.catalog.item.facet.ShapefileFacet', 'name': stem, 'files': facet_files}
+                if bbox:
+                    facet['boundingBox'] = dict(bbox)
+                item.setdefault('facets', []).append(facet)
+            item['files'] = files
+            return(self._json(item))
+
+    def upload_file_to_item(self, item, filename, scrape_file=True):
+        self._call('upload_file_to_item')
+        return(self._add_files(item['id'], [filename]))
+
+    def upload_files_and_upsert_item(self, item, filenames, scrape_file=True):
+        self._call('upload_files_and_upsert_item')
+        item_id = item['id'] if item.get('id') in self.items else self._create(item)['id']
+        self._update(dict(item, id=item_id))
+        return(self._add_files(item_id, filenames))
+
+    def upload_files_and_update_item(self, item, filenames, scrape_file=True):
+        self._call('upload_files_and_update_item')
+        self._update(item)
+        return(self._add_files(item['id'], filenames))
+
+    def replace_file(self, filename, item):
+        self._call('replace_file')
+        return(self._add_files(item['id'], [filename]))
+
+    def report(self):
+        return("Fake SB session: {} items, {} calls ({}).".format(len(self.items), sum(self.calls.values()),
+               ', '.join(['{} {}'.format(n, m) for m, n in sorted(self.calls.items())])))
+
+def _xml_bbox(xml_file):
+    # SB boundingBox from the bounding coordinates of an FGDC XML, or None
+    try:
+        bounding = etree.parse(xml_file).getroot().find('./idinfo/spdom/bounding')
+        return({'minX': float(bounding.findtext('westbc')), 'maxX': float(bounding.findtext('eastbc')),
+                'minY': float(bounding.findtext('southbc')), 'maxY': float(bounding.findtext('northbc'))})
+    except Exception:
+        return(None)
+
+#%% Synthetic releases
+def fgdc_xml(title, bbox=(-75.0, -74.0, 38.0, 39.0), browse_file='browse.png', nattrs=0, ndomains=0):
+    # Text of an FGDC CSDGM XML with the elements that autoSB reads and updates.
+    # bbox is (west, east, south, north). With nattrs > 0, an eainfo block is added with nattrs attributes
+    # of ndomains enumerated domain values each.
+    west, east, south, north = bbox
+    attrs = ''.join(['''
+        <attr><attrlabl>FIELD{0}</attrlabl><attrdef>Attribute {0} of {1}</attrdef><attrdefs>Producer defined</attrdefs>
+          <attrdomv>{2}</attrdomv></attr>'''.format(i, title, ''.join(['''
+            <edom><edomv>{0}</edomv><edomvd>Value {0} of attribute {1}</edomvd><edomvds>Producer defined</edomvds></edom>'''.format(j, i)
+            for j in range(ndomains)])) for i in range(nattrs)])
+    eainfo = '''
+  <eainfo><detailed><enttyp><enttypl>{}</enttypl><enttypd>Attribute table</enttypd><enttypds>Producer defined</enttypds></enttyp>{}
+  </detailed></eainfo>'''.format(title, attrs) if nattrs else ''
+    return('''<?xml version="1.0" encoding="UTF-8"?>
+<metadata>
+  <idinfo>
+    <citation><citeinfo>
+      <origin>U.S. Geological Survey</origin>
+      <pubdate>2019</pubdate>
+      <title>{title}</title>
+      <edition>1.0</edition>
+      <serinfo><sername>data release</sername><issue>DOI:10.5066/XXXXXXXX</issue></serinfo>
+      <pubinfo><pubplace>Woods Hole, MA</pubplace><publish>U.S. Geological Survey</publish></pubinfo>
+      <onlink>https://doi.org/10.5066/XXXXXXXX</onlink>
+      <onlink>https://www.sciencebase.gov/catalog/item/xxxxxxxx</onlink>
+      <lworkcit><citeinfo>
+        <origin>U.S. Geological Survey</origin>
+        <pubdate>2019</pubdate>
+        <title>Synthetic data release</title>
+        <serinfo><sername>data release</sername><issue>DOI:10.5066/XXXXXXXX</issue></serinfo>
+        <onlink>https://doi.org/10.5066/XXXXXXXX</onlink>
+        <onlink>https://www.sciencebase.gov/catalog/item/xxxxxxxx</onlink>
+      </citeinfo></lworkcit>
+    </citeinfo></citation>
+    <descript><abstract>Synthetic dataset {title} for testing.</abstract><purpose>Testing</purpose></descript>
+    <timeperd><timeinfo><sngdate><caldate>2019</caldate></sngdate></timeinfo><current>ground condition</current></timeperd>
+    <status><progress>Complete</progress><update>None planned</update></status>
+    <spdom><bounding><westbc>{west}</westbc><eastbc>{east}</eastbc><northbc>{north}</northbc><southbc>{south}</southbc></bounding></spdom>
+    <browse><browsen>{browse}</browsen><browsed>Image of {title}</browsed><browset>PNG</browset></browse>
+  </idinfo>{eainfo}
+  <distinfo>
+    <distrib><cntinfo><cntorgp><cntorg>U.S. Geological Survey - ScienceBase</cntorg></cntorgp></cntinfo></distrib>
+    <stdorder><digform>
+      <digtinfo><formname>Shapefile</formname></digtinfo>
+      <digtopt><onlinopt>
+        <computer><networka><networkr>https://www.sciencebase.gov/catalog/item/xxxxxxxx</networkr></networka></computer>
+        <computer><networka><networkr>https://www.sciencebase.gov/catalog/file/get/xxxxxxxx</networkr></networka></computer>
+        <computer><networka><networkr>https://doi.org/10.5066/XXXXXXXX</networkr></networka></computer>
+        <accinstr>Access instructions</accinstr>
+      </onlinopt></digtopt>
+    </digform><fees>None</fees></stdorder>
+  </distinfo>
+  <metainfo><metd>20190101</metd><metstdn>FGDC Content Standard for Digital Geospatial Metadata</metstdn><metstdv>FGDC-STD-001-1998</metstdv></metainfo>
+</metadata>
+'''.format(title=title, west=west, east=east, south=south, north=north, browse=browse_file, eainfo=eainfo))
+
+def _tree_paths(npages, fanout):
+    # Relative directory paths of npages data directories, fanout per parent, with as many group levels as needed
+    levels = 1
+    while fanout ** levels < npages:
+        levels += 1
+    paths = []
+    for n in range(npages):
+        parts = []
+        for level in range(levels - 1, 0, -1):
+            parts.append('group{}'.format((n // fanout ** level) % fanout))
+        parts.append('data{}'.format(n))
+        paths.append(os.path.join(*parts))
+    return(paths)
+
+def _bbox(n, rng):
+    west = rng.uniform(-100, -70)
+    south = rng.uniform(25, 45)
+    return((round(west, 4), round(west + 0.5, 4), round(south, 4), round(south + 0.5, 4)))
+
+def make_release(parentdir, npages=1000, fanout=10, seed=0, nattrs=0, ndomains=0, shapefiles=False):
+    # Write a data release of npages data directories below parentdir, fanout per parent directory.
+    # Each data directory has an XML titled 'Dataset n', a browse graphic, and a small data file (or a shapefile set).
+    # Returns the list of XML files.
+    rng = random.Random(seed)
+    xmllist = []
+    for n, relpath in enumerate(_tree_paths(npages, fanout)):
+        datadir = os.path.join(parentdir, relpath)
+        os.makedirs(datadir, exist_ok=True)
+        stem = 'dataset{}'.format(n)
+        xml_file = os.path.join(datadir, stem + '_meta.xml')
+        with open(xml_file, 'w') as f:
+            f.write(fgdc_xml('Dataset {}'.format(n), _bbox(n, rng), stem + '_browse.png', nattrs, ndomains))
+        with open(os.path.join(datadir, stem + '_browse.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + bytes([n % 256]) * 64)
+        for ext in (('.shp', '.shx', '.dbf', '.prj') if shapefiles else ('.csv',)):
+            with open(os.path.join(datadir, stem + ext), 'w') as f:
+                f.write('id,value\n' + ''.join(['{},{}\n'.format(i, rng.random()) for i in range(20)]))
+        xmllist.append(xml_file)
+    return(xmllist)
+
+def make_page_tree(sb, landing_id, npages=1000, fanout=10, seed=0):
+    # Create pages in the FakeSbSession mirroring make_release(): group pages and npages data pages
+    # with a bounding box facet. Returns the list of data page IDs.
+    rng = random.Random(seed)
+    ids = {'': landing_id}
+    datapages = []
+    for n, relpath in enumerate(_tree_paths(npages, fanout)):
+        parts = relpath.split(os.sep)
+        for depth in range(1, len(parts) + 1):
+            key = os.sep.join(parts[:depth])
+            if not key in ids:
+                ids[key] = sb._create({'parentId': ids[os.sep.join(parts[:depth-1])], 'title': parts[depth-1]})['id']
+        west, east, south, north = _bbox(n, rng)
+        sb._update({'id': ids[relpath], 'title': 'Dataset {}'.format(n),
+                    'facets': [{'className': 'gov.sciencebase.catalog.item.facet.ShapefileFacet', 'files': [],
+                                'boundingBox': {'minX': west, 'maxX': east, 'minY': south, 'maxY': north}}]})
+        datapages.append(ids[relpath])
+    return(datapages)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+sb_record.py
+
+OVERVIEW: Record the ScienceBase (SB) calls made during a run and play them back later
+without a connection to SB, so that runs of sb_automation.py can be timed and compared offline.
+
+RecordingSbSession wraps a logged-in SbSession and appends each call to the methods in
+recorded_methods, with its response (or error) and duration, to a cassette file (one JSON
+object per line). ReplaySbSession reads a cassette and returns the recorded responses for
+calls with the same method and arguments, in the order they were recorded, optionally
+waiting a fixed or recorded time for each call.
+
+Local paths in the arguments (e.g. files to upload) are stored relative to root, if given,
+so that a cassette recorded on one machine can be replayed with the data release in another
+location.
+
+REQUIRES: sciencebasepy (to record)
+"""
+#%% Import packages
+import os
+import copy
+import json
+import time
+import threading
+
+__all__ = ['recorded_methods', 'call_key', 'RecordingSbSession', 'ReplaySbSession']
+
+# SbSession methods used by autoSB.py whose calls are recorded and replayed
+recorded_methods = ('get_item', 'get_child_ids', 'get_ancestor_ids', 'find_items', 'find_items_by_title', 'next',
+                    'create_item', 'create_items', 'update_item', 'update_items', 'upload_file_to_item',
+                    'upload_files_and_upsert_item', 'upload_files_and_update_item', 'replace_file',
+                    'delete_item', 'delete_items')
+
+def _normalize(value, root=None):
+    # Copy of a call argument with local paths under root made relative to it, with '/' separators
+    if isinstance(value, str):
+        if root and os.path.isabs(value) and os.path.abspath(value).startswith(root + os.sep):
+            return('<root>/' + os.path.relpath(os.path.abspath(value), root).replace(os.sep, '/'))
+        return(value)
+    if isinstance(value, dict):
+        return(dict([(k, _normalize(v, root)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return([_normalize(v, root) for v in value])
+    return(value)
+
+def call_key(method, args, kwargs, root=None):
+    # String that identifies a call by its method and arguments
+    return(json.dumps([method, _normalize(list(args), root), _normalize(kwargs, root)], sort_keys=True, default=str))
+
+class RecordingSbSession(object):
+    # Wrap an SbSession so that each call to the recorded methods is appended to the cassette file.
+    # All other attributes are passed through to the wrapped session.
+    def __init__(self, sb, cassette, root=None, append=False):
+        self._sb = sb
+        self.cassette = cassette
+        self.root = os.path.abspath(root) if root else None
+        self.calls = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(cassette)), exist_ok=True)
+        if not append:
+            open(cassette, 'w').close()
+
+    def __getattr__(self, name):
+        attr = getattr(self._sb, name)
+        if not name in recorded_methods:
+            return(attr)
+        def recorded(*args, **kwargs):
+            start = time.time()
+            entry = {'key': call_key(name, args, kwargs, self.root), 'method': name}
+            try:
+                response = attr(*args, **kwargs)
+                entry['response'] = response
+                return(response)
+            except Exception as e:
+                entry['error'] = "{}: {}".format(type(e).__name__, e)
+                raise
+            finally:
+                entry['seconds'] = round(time.time() - start, 4)
+                with self._lock:
+                    with open(self.cassette, 'a') as f:
+                        f.write(json.dumps(entry, default=str) + '\n')
+                    self.calls += 1
+        return(recorded)
+
+class ReplaySbSession(object):
+    # Stand-in for an SbSession that answers the recorded methods from a cassette file.
+    # Calls with the same key are answered in recorded order; once those run out, the last response is repeated.
+    # latency is the seconds to wait per call: a number, a dictionary of {method: seconds}, or 'recorded'.
+    # A call that was not recorded raises KeyError.
+    def __init__(self, cassette, root=None, latency=0):
+        self.cassette = cassette
+        self.root = os.path.abspath(root) if root else None
+        self.latency = latency
+        self.calls = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {} # key: [entries]
+        self._next = {} # key: index of the next entry
+        with open(cassette, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry['key'], []).append(entry)
+
+    def __len__(self):
+        return(sum([len(entries) for entries in self._entries.values()]))
+
+    def is_logged_in(self):
+        return(True)
+
+    def _wait(self, method, entry):
+        if self.latency == 'recorded':
+            seconds = entry.get('seconds', 0)
+        elif isinstance(self.latency, dict):
+            seconds = self.latency.get(method, 0)
+        else:
+            seconds = self.latency
+        if seconds:
+            time.sleep(seconds)
+
+    def __getattr__(self, name):
+        if not name in recorded_methods:
+            raise AttributeError("'{}' calls are not recorded, so they can't be replayed.".format(name))
+        def replayed(*args, **kwargs):
+            key = call_key(name, args, kwargs, self.root)
+            with self._lock:
+                self.calls += 1
+                entries = self._entries.get(key)
+                if not entries:
+                    self.misses += 1
+                    raise KeyError("No recorded response for {}".format(key[:200]))
+                idx = self._next.get(key, 0)
+                self._next[key] = min(idx + 1, len(entries) - 1)
+                entry = entries[idx]
+            self._wait(name, entry)
+            if 'error' in entry:
+                raise Exception(entry['error'])
+            return(copy.deepcopy(entry.get('response')))
+        return(replayed)
+
+    def report(self):
+        return("Replayed {} SB calls from {} ({} not recorded).".format(self.calls, self.cassette, self.misses))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+bench_rename_dirs.py
+
+Benchmark rename_dirs_from_xmls() on a synthetic data release tree.
+
+Builds a temporary tree of nested directories (5000 data directories by default), each
+data directory holding one FGDC XML with a title that differs from the directory name.
+The top-level group directories also hold an XML, as intermediate pages can. Times the
+directory checks done by the original per-XML globbing against the same checks from a
+single manifest scan, then times the full rename pass and confirms that every data
+directory was renamed to its title.
+
+Usage: python bench_rename_dirs.py [number of directories]
+"""
+#%% Import packages
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+try:
+    sb_auto_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+except:
+    sb_auto_dir = os.path.dirname(os.getcwd())
+sys.path.append(sb_auto_dir)
+from autoSB import *
+
+xml_template = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata><idinfo><citation><citeinfo><title>{}</title></citeinfo></citation></idinfo></metadata>
+"""
+
+def make_tree(parentdir, ndirs=5000, fanout=10):
+    # Three levels of intermediate directories with data directories at the bottom
+    ct = 0
+    datadirs = []
+    while ct < ndirs:
+        for i in range(fanout):
+            for j in range(fanout):
+                d = os.path.join(parentdir, 'group{}'.format(len(datadirs) // (fanout*fanout*10)),
+                                 'set{}'.format(i), 'dir{}_{}'.format(j, ct))
+                os.makedirs(d)
+                group_xml = os.path.join(parentdir, 'group{}'.format(len(datadirs) // (fanout*fanout*10)), 'group.xml')
+                if not os.path.exists(group_xml):
+                    with open(group_xml, 'w') as f:
+                        f.write(xml_template.format('Group'))
+                with open(os.path.join(d, 'meta.xml'), 'w') as f:
+                    f.write(xml_template.format('Data page {}'.format(ct)))
+                datadirs.append(d)
+                ct += 1
+                if ct >= ndirs:
+                    return(datadirs)
+    return(datadirs)
+
+def legacy_checks(parentdir):
+    # Directory checks made by the original rename_dirs_from_xmls: a subtree glob and a listdir per XML
+    for xml_file in glob.glob(os.path.join(parentdir, '**/*.xml'), recursive=True):
+        datadir = os.path.dirname(xml_file)
+        len(glob.glob(os.path.join(datadir, '**/*.xml'), recursive=True)) == 1
+        any([os.path.isdir(os.path.join(datadir,fn)) for fn in os.listdir(datadir)])
+
+def manifest_checks(parentdir):
+    # The same checks from one scan of the tree
+    release = ReleaseManifest(parentdir)
+    xml_counts = release.xml_counts(parentdir)
+    for xml_file in release.xmls(parentdir):
+        datadir = os.path.dirname(xml_file)
+        xml_counts.get(datadir) == 1
+        len(release.subdirs(datadir))
+
+#%% Run benchmark
+if __name__ == '__main__':
+    ndirs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    tmpdir = tempfile.mkdtemp()
+    parentdir = os.path.join(tmpdir, 'release')
+    try:
+        datadirs = make_tree(parentdir, ndirs)
+        print("Built {} data directories in {}".format(len(datadirs), parentdir))
+
+        start = time.perf_counter()
+        legacy_checks(parentdir)
+        legacy = time.perf_counter() - start
+        print("Per-XML globbing checks:   {:8.2f} s".format(legacy))
+
+        start = time.perf_counter()
+        manifest_checks(parentdir)
+        current = time.perf_counter() - start
+        print("Manifest checks:           {:8.2f} s ({:.1f}x faster)".format(current, legacy / current))
+
+        start = time.perf_counter()
+        rename_dirs_from_xmls(parentdir)
+        print("rename_dirs_from_xmls:     {:8.2f} s (includes parsing and renaming)".format(time.perf_counter() - start))
+
+        renamed = glob.glob(os.path.join(parentdir, '*', '*', 'Data page *', 'meta.xml'))
+        if len(renamed) != len(datadirs):
+            print("ERROR: {} of {} directories were renamed.".format(len(renamed), len(datadirs)))
+            sys.exit(1)
+        print("All {} data directories renamed.".format(len(renamed)))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+bench_sb_scale.py
+
+Time how the main autoSB routines scale with the size of a data release, using the
+in-memory FakeSbSession from sb_fake.py instead of ScienceBase.
+
+For each release size (1000, 2000, and 4000 data pages by default), builds a synthetic
+release of shapefile data directories and a landing page, then times setup_subparents,
+upload_all_datapages, inherit_topdown, and set_parent_extent and counts the SB calls each
+makes. Doubling the release should roughly double the time and calls; a phase whose time
+or calls grow more than three times when the size doubles is flagged as a likely
+quadratic (O(n^2)) regression, and the script exits with status 1.
+
+Usage: python bench_sb_scale.py [release sizes...]
+"""
+#%% Import packages
+import os
+import sys
+import io
+import time
+import shutil
+import tempfile
+import contextlib
+try:
+    sb_auto_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+except:
+    sb_auto_dir = os.path.dirname(os.getcwd())
+sys.path.append(sb_auto_dir)
+from autoSB import *
+from sb_fake import FakeSbSession, make_release
+
+phases = ['setup_subparents', 'upload_all_datapages', 'inherit_topdown', 'set_parent_extent']
+
+def run_phases(npages, tmpdir):
+    # Time each phase on a new release of npages data pages. Returns {phase: (seconds, SB calls)}.
+    parentdir = os.path.join(tmpdir, 'release{}'.format(npages))
+    xmllist = make_release(parentdir, npages, shapefiles=True)
+    sb = FakeSbSession()
+    landing_id = sb.create_item({'title': 'Landing page', 'citation': 'Synthetic data release citation'})['id']
+    release = ReleaseManifest(parentdir)
+    results = {}
+    def timed(phase, function, *args, **kwargs):
+        ncalls = sum(sb.calls.values())
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = function(*args, **kwargs)
+        results[phase] = (time.perf_counter() - start, sum(sb.calls.values()) - ncalls)
+        return(out)
+    dict_DIRtoID = timed('setup_subparents', setup_subparents, sb, parentdir, landing_id, False, verbose=False, release=release)
+    valid_ids = set(sb.get_ancestor_ids(landing_id))
+    timed('upload_all_datapages', upload_all_datapages, sb, xmllist, dict_DIRtoID, parentdir, valid_ids=valid_ids,
+          workers=4, release=release)
+    timed('inherit_topdown', inherit_topdown, sb, landing_id, ['citation'], ['citation'])
+    timed('set_parent_extent', set_parent_extent, sb, landing_id)
+    return(results)
+
+#%% Run benchmark
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 2000, 4000]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        runs = [(n, run_phases(n, tmpdir)) for n in sizes]
+    finally:
+        shutil.rmtree(tmpdir)
+    print("{:>8} ".format('pages') + ''.join(["{:>24}".format(phase) for phase in phases]))
+    for n, results in runs:
+        print("{:>8} ".format(n) + ''.join(["{:>13.2f} s {:>7} calls".format(*results[phase]) for phase in phases]))
+    flagged = []
+    for (n1, r1), (n2, r2) in zip(runs, runs[1:]):
+        for phase in phases:
+            # Allow for timer noise on very short phases
+            time_growth = r2[phase][0] / max(r1[phase][0], 0.05)
+            call_growth = r2[phase][1] / float(max(r1[phase][1], 1))
+            limit = 1.5 * n2 / n1
+            if time_growth > limit or call_growth > limit:
+                flagged.append("{} grew {:.1f}x in time and {:.1f}x in calls from {} to {} pages.".format(phase, time_growth, call_growth, n1, n2))
+    if flagged:
+        print("Possible quadratic scaling:")
+        print(*flagged, sep="\n")
+        sys.exit(1)
+    print("All phases scale linearly.")
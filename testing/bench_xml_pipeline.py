@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+bench_xml_pipeline.py
+
+Benchmark the XML functions in autoSB.py on generated FGDC CSDGM files and compare the
+results with a saved baseline.
+
+Fixtures are written to a temporary directory with fgdc_xml() and make_release() from
+sb_fake.py: a small XML, a large XML with an eainfo block of many attributes and domain
+values (the attrdomv blocks have several values each, which fix_attrdomv_error splits),
+and a release tree of 1000 XMLs. Each benchmark is run 'repeat' times with new copies of
+its inputs, which are not timed, and the best and median times per call are recorded.
+
+Results are saved as JSON. Given a baseline (a results file from an earlier run), each
+benchmark whose best time is slower than the baseline by more than the threshold is
+reported as a regression and the script exits with status 1.
+
+Usage:
+    python bench_xml_pipeline.py [--files 1000] [--repeat 5] [--output results.json]
+                                 [--baseline baseline.json] [--threshold 0.2] [--only name ...]
+"""
+#%% Import packages
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+from datetime import datetime
+from collections import OrderedDict
+from lxml import etree
+try:
+    sb_auto_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+except:
+    sb_auto_dir = os.path.dirname(os.getcwd())
+sys.path.append(sb_auto_dir)
+from autoSB import *
+from sb_fake import fgdc_xml, make_release
+
+new_values = {'landing_id': '5a54fbc3e4b01e7be242b917', 'doi': '10.5066/P9XXXXXX', 'pubdate': '2020', 'child_id': '5f28109582cef313ed9cd787',
+              'browse_file': 'dataset0_browse.png',
+              'find_and_replace': {'Woods Hole, MA': 'Woods Hole, Massachusetts', 'data release': 'Data release', 'XXXXXXXX': 'P9XXXXXX'}}
+
+def make_fixtures(tmpdir, nfiles):
+    # Write the small and large XMLs and a release tree of nfiles XMLs. Returns a dictionary of their paths.
+    fixtures = {'small': os.path.join(tmpdir, 'small_meta.xml'), 'large': os.path.join(tmpdir, 'large_meta.xml'),
+                'release': os.path.join(tmpdir, 'release')}
+    with open(fixtures['small'], 'w') as f:
+        f.write(fgdc_xml('Small dataset'))
+    with open(fixtures['large'], 'w') as f:
+        f.write(fgdc_xml('Large dataset', nattrs=60, ndomains=40))
+    fixtures['xmllist'] = make_release(fixtures['release'], nfiles)
+    return(fixtures)
+
+def copy_file(tmpdir, fpath):
+    # New copy of a fixture file, so that functions that change it always start from the same input
+    out = os.path.join(tmpdir, 'work', os.path.basename(fpath))
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    for fn in (out, out + '_orig'):
+        if os.path.exists(fn):
+            os.remove(fn)
+    shutil.copy(fpath, out)
+    return(out)
+
+def copy_release(tmpdir, fixtures):
+    # New copy of the release tree and a dictionary of page IDs for its XMLs
+    parentdir = os.path.join(tmpdir, 'work', 'release')
+    if os.path.exists(parentdir):
+        shutil.rmtree(parentdir)
+    shutil.copytree(fixtures['release'], parentdir)
+    release = ReleaseManifest(parentdir)
+    dict_DIRtoID = dict([(xml_file, '{:024x}'.format(n)) for n, xml_file in enumerate(release.xmls())])
+    return(parentdir, release, dict_DIRtoID)
+
+def benchmarks(tmpdir, fixtures, nfiles):
+    # Dictionary of {name: (setup, function, number)}: setup() returns the arguments for one run, which calls
+    # function(*args) number times.
+    def parsed(name):
+        return(lambda: (etree.parse(fixtures[name]).getroot(),))
+    def release_args(workers):
+        def setup():
+            parentdir, release, dict_DIRtoID = copy_release(tmpdir, fixtures)
+            return(parentdir, dict(new_values), None, dict_DIRtoID, False, release, XmlDocCache(), workers)
+        return(setup)
+    return(OrderedDict([
+        ('get_title_from_data[small]', (lambda: (fixtures['small'],), get_title_from_data, 100)),
+        ('get_title_from_data[large]', (lambda: (fixtures['large'],), get_title_from_data, 20)),
+        ('update_xml[small]', (lambda: (copy_file(tmpdir, fixtures['small']), dict(new_values)), update_xml, 1)),
+        ('update_xml[large]', (lambda: (copy_file(tmpdir, fixtures['large']), dict(new_values)), update_xml, 1)),
+        ('fix_attrdomv_error[large]', (parsed('large'), fix_attrdomv_error, 1)),
+        ('remove_xml_element[small]', (lambda: (etree.parse(fixtures['small']).getroot(), './distinfo/stdorder/digform', 'XXXXXXXX'), remove_xml_element, 1)),
+        ('remove_xml_element[large]', (lambda: (etree.parse(fixtures['large']).getroot(), './eainfo/detailed/attr', 'FIELD1'), remove_xml_element, 1)),
+        ('find_and_replace_from_dict[small]', (lambda: (copy_file(tmpdir, fixtures['small']), new_values['find_and_replace']), find_and_replace_from_dict, 1)),
+        ('find_and_replace_from_dict[large]', (lambda: (copy_file(tmpdir, fixtures['large']), new_values['find_and_replace']), find_and_replace_from_dict, 1)),
+        ('map_newvals2xml+flip_dict', (lambda: (new_values,), lambda nv: flip_dict(map_newvals2xml(nv)), 1000)),
+        ('update_all_xmls[{}]'.format(nfiles), (release_args(1), update_all_xmls, 1)),
+        ('update_all_xmls[{},4 workers]'.format(nfiles), (release_args(4), update_all_xmls, 1)),
+    ]))
+
+def run(setup, function, number, repeat):
+    # Best and median seconds per call over repeat runs; printed output is discarded
+    times = []
+    for i in range(repeat):
+        args = setup()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            for j in range(number):
+                function(*args)
+            times.append((time.perf_counter() - start) / number)
+    times.sort()
+    return({'best': times[0], 'median': times[len(times) // 2], 'repeat': repeat, 'number': number})
+
+def compare(results, baseline, threshold):
+    # Print each result against the baseline. Returns the names of benchmarks slower than the baseline by more than threshold.
+    regressions = []
+    print("{:<40}{:>12}{:>12}{:>9}".format('benchmark', 'best (ms)', 'baseline', 'ratio'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("{:<40}{:>12.3f}{:>12}".format(name, 1000 * result['best'], '-'))
+            continue
+        ratio = result['best'] / base['best'] if base['best'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{:<40}{:>12.3f}{:>12.3f}{:>9.2f}{}".format(name, 1000 * result['best'], 1000 * base['best'], ratio, flag))
+    return(regressions)
+
+#%% Run benchmarks
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the autoSB XML functions.')
+    parser.add_argument('--files', type=int, default=1000, help='number of XMLs in the release tree')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of each benchmark')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown from the baseline (0.2 = 20%%)')
+    parser.add_argument('--only', nargs='*', help='run only the benchmarks whose names start with these')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    results = OrderedDict()
+    try:
+        fixtures = make_fixtures(tmpdir, args.files)
+        for name, (setup, function, number) in benchmarks(tmpdir, fixtures, args.files).items():
+            if args.only and not any([name.startswith(prefix) for prefix in args.only]):
+                continue
+            results[name] = run(setup, function, number, args.repeat)
+            print("{:<40}{:>12.3f} ms".format(name, 1000 * results[name]['best']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {'created': datetime.now().isoformat(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'files': args.files, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Saved results to {}".format(args.output))
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        print('')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("{} benchmark(s) slower than the baseline by more than {:.0%}.".format(len(regressions), args.threshold))
+            sys.exit(1)
+        print("No regressions beyond {:.0%} of the baseline.".format(args.threshold))